@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from cgi import escape
+import json
+
+from plone.protect import CheckAuthenticator
+from plone.protect.authenticator import createToken
+from Products.Five.browser import BrowserView
+
+from plone.wabac.modlog import instrument
+from plone.wabac.modlog.export import CONTENT_TYPES, export_chunks, parse_time
+from plone.wabac.modlog.interfaces import IModificationLogger
+from plone.wabac.modlog.prune import chunked_prune
+from plone.wabac.modlog.segments import INDEXES
+
+
+PRUNE_FORM = """\
+<html><body>
+<form method="post" action="%(action)s">
+  <p>Remove records of %(facility)s logged more than %(days)s days ago?</p>
+  <input type="hidden" name="_authenticator" value="%(token)s" />
+  <input type="hidden" name="days" value="%(days)s" />
+  <input type="hidden" name="facility" value="%(facility_name)s" />
+  <input type="hidden" name="chunk" value="%(chunk)s" />
+  <input type="hidden" name="chunks" value="%(chunks)s" />
+  <input type="submit" value="Prune" />
+</form>
+</body></html>
+"""
+
+
+class PruneView(BrowserView):
+    """
+    Chunked pruning of the site modification log, e.g.:
+
+        /Plone/@@modlog-prune?days=365&chunk=1000&chunks=10
+
+    Records are only removed by a POST with a valid authenticator (CSRF
+    protection): a GET shows a form to confirm with.  For periodic
+    pruning (e.g. from cron), use the modlog/prune.py script instead.
+
+    Each chunk is committed separately; with 'chunks' given, a call
+    stops after that many chunks, and the next call resumes.
+    """
+
+    def confirm(self, facility, days, chunk, chunks):
+        """Form to confirm pruning with, by POST, with authenticator"""
+        values = {
+            'action': self.request.getURL(),
+            'facility': facility or 'all facilities',
+            'facility_name': facility or '',
+            'days': days,
+            'chunk': chunk,
+            'chunks': chunks or '',
+            'token': createToken(),
+            }
+        return PRUNE_FORM % dict(
+            (name, escape(unicode(value), quote=True))
+            for name, value in values.items()
+            )
+
+    def __call__(self):
+        form = self.request.form
+        response = self.request.response
+        try:
+            days = float(form['days'])
+            chunk = int(form.get('chunk', 1000))
+            chunks = int(form['chunks']) if form.get('chunks') else None
+        except (KeyError, ValueError):
+            response.setHeader('Content-Type', 'text/plain')
+            response.setStatus(400)
+            return 'Parameter days (number) is required.'
+        facility = form.get('facility') or None
+        if self.request.get('REQUEST_METHOD') != 'POST':
+            return self.confirm(facility, form['days'], chunk, chunks)
+        CheckAuthenticator(self.request)  # raises Forbidden if invalid
+        response.setHeader('Content-Type', 'text/plain')
+        removed = chunked_prune(
+            IModificationLogger(self.context),
+            facility,
+            days,
+            chunk=chunk,
+            chunks=chunks,
+            )
+        if not removed:
+            return 'No records removed.'
+        return '\n'.join(
+            '%s: %s records removed' % (name, count)
+            for name, count in sorted(removed.items())
+            )
+
+
+class ExportView(BrowserView):
+    """
+    Streaming export of one facility of the site modification log, as
+    JSON lines (default) or CSV, e.g.:
+
+        /Plone/@@modlog-export?facility=deletions&format=csv&since=2016-01-01
+
+    Optional uid, user and path filters are as for limit(), since and
+    until are ISO dates or date-times (since inclusive, until exclusive),
+    and expand=1 includes records for descendants of removed folders.
+
+    Records are written to the response in chunks.  Once each chunk is
+    written, the connection of a separate log database is emptied of
+    the log objects loaded; the site's own connection, when storing the
+    log, is only garbage-collected, keeping the site's objects cached.
+    """
+
+    chunk = 1000
+
+    def __call__(self):
+        form = self.request.form
+        response = self.request.response
+        logger = IModificationLogger(self.context)
+        name = form.get('facility', '')
+        name = logger.ACTION_FACILITIES.get(name, name)
+        format = form.get('format', 'jsonl')
+        try:
+            if name not in logger.ACTION_FACILITIES.values():
+                raise ValueError('Unknown facility: %r' % name)
+            if format not in CONTENT_TYPES:
+                raise ValueError('Unknown format: %r' % format)
+            since, until = [
+                parse_time(form[k]) if form.get(k) else None
+                for k in ('since', 'until')
+                ]
+        except ValueError as e:
+            response.setStatus(400)
+            response.setHeader('Content-Type', 'text/plain')
+            return str(e)
+        filters = dict((k, form[k]) for k in INDEXES if form.get(k))
+        facility = getattr(logger, name)
+        records = facility.limit(
+            filters,
+            expand=bool(form.get('expand')),
+            since=since,
+            until=until,
+            )
+        jar = getattr(logger.storage(), '_p_jar', None)
+        after_chunk = None
+        if jar is not None:
+            shared = jar is getattr(self.context, '_p_jar', None)
+            after_chunk = jar.cacheGC if shared else jar.cacheMinimize
+        response.setHeader('Content-Type', CONTENT_TYPES[format])
+        response.setHeader(
+            'Content-Disposition',
+            'attachment; filename="%s.%s"' % (name, format),
+            )
+        chunks = export_chunks(records, format, self.chunk, after_chunk)
+        for chunk in chunks:
+            response.write(chunk)
+        return ''
+
+
+class StatsView(BrowserView):
+    """
+    Instrumentation totals from the in-process registry (when enabled,
+    see plone.wabac.modlog.instrument), as JSON keyed by facility and
+    call; reset=1 resets totals after reading them.
+    """
+
+    def __call__(self):
+        stats = instrument.registry.snapshot()
+        if self.request.form.get('reset'):
+            instrument.registry.reset()
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(
+            dict(('%s.%s' % key, value) for key, value in stats.items()),
+            indent=2,
+            sort_keys=True,
+            )
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import json
+
+from Products.Five.browser import BrowserView
+
+from plone.wabac.modlog.interfaces import IModificationLogger
+from plone.wabac.restore.batch import BatchRestore
+
+
+def _uids(value):
+    if isinstance(value, basestring):
+        return [value]
+    return value or []
+
+
+class RestorePreviewView(BrowserView):
+    """
+    Preview (dry run) of restoring content, as JSON, given UIDs of items
+    deleted and/or modified, e.g.:
+
+        /Plone/@@restore-preview?deleted:list=<uid>&modified:list=<uid>
+
+    Items are restored as of before the latest deletion or modification
+    logged for their UID; see BatchRestore.preview() for the mapping
+    returned.  Nothing is written.
+    """
+
+    def records(self, facility, uids):
+        """
+        Latest record logged in facility for each UID, if any, also of
+        removal with a folder
+        """
+        for uid in uids:
+            records = facility.limit({'uid': uid}, expand=True)
+            record = next(iter(records), None)
+            if record is not None:
+                yield record
+
+    def __call__(self):
+        form = self.request.form
+        logger = IModificationLogger(self.context)
+        restore = BatchRestore(
+            self.context,
+            deleted=self.records(logger.deletions, _uids(form.get('deleted'))),
+            modified=self.records(
+                logger.modifications,
+                _uids(form.get('modified')),
+                ),
+            )
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps(restore.preview(), default=unicode, indent=2)
@@ -2,22 +2,30 @@
 
 from datetime import datetime, timedelta
 
+import cPickle
 import itertools
-import random
+import operator
 
+from Acquisition import aq_base
 import BTrees
-from persistent.mapping import PersistentMapping
-from persistent.list import PersistentList
+import transaction
 from plone.uuid.interfaces import IUUID
 from Products.CMFCore.utils import getToolByName
-from zope.annotation.interfaces import IAnnotations
 from zope.component.hooks import getSite
 from zope.interface import implements
 
+from backends import ANNO_KEY, storage_backend  # noqa
+import instrument
 from interfaces import IChangeEnumeration, IModificationLogger
+from keys import decode_cursor, encode_cursor, epoch_ms, key_clock
+from keys import month_partition, partition_of, slot_of, time_bounds
+from records import ChangeRecord, TransactionMarker, expand_descendants
+from segments import AGGREGATES, INDEXES, LogSegment, SEGMENTS, merge
+from segments import writer_slot
 
 
-ANNO_KEY = 'plone.wabac.modlog'
+# Name under which removal of transaction markers is reported by prune:
+MARKERS = u'transactions'
 
 
 class ChangesetView(object):
@@ -25,6 +33,9 @@ class ChangesetView(object):
     Adapter/wrapper around storage of named changeset facility,
     provides mapping ordered in LIFO order; such order is expected
     to be provided on insertion by modification logger.
+
+    Facility storage maps (monthly) partition numbers, newest first, to
+    partitions, each mapping segment numbers to segments of records.
     """
 
     implements(IChangeEnumeration)
@@ -34,7 +45,6 @@ class ChangesetView(object):
             raise ValueError('Valid modification logger not provided.')
         self.__parent__ = self.context = context
         self.__name__ = unicode(name)
-        self._keyname = '%s_keys' % self.__name__
 
     def _storage(self, name=None):
         name = name or self.__name__
@@ -43,14 +53,41 @@ class ChangesetView(object):
             return None
         return core.get(name)
 
-    def _keystore(self):
-        return self._storage(self._keyname)
+    def _partitions(self, after=None, first=None, last=None):
+        """
+        Partitions newest first, or from partition of key 'after' (or
+        of key first, if greater), to partition of key last, if given.
+        """
+        partitions = self._storage()
+        if partitions is None:
+            return ()
+        bounds = {}
+        newest = max(after, first)  # None (no bound) compares smallest
+        if newest is not None:
+            bounds['min'] = partition_of(newest)
+        if last is not None:
+            bounds['max'] = partition_of(last)
+        return partitions.values(**bounds)
+
+    def _segments(self):
+        return [s for p in self._partitions() for s in p.values()]
+
+    def _segment(self, key):
+        partitions = self._storage()
+        partition = partitions.get(partition_of(key)) if partitions else None
+        if partition is None:
+            return None
+        return partition.get(slot_of(key))
+
+    def _records(self, key):
+        segment = self._segment(key)
+        return segment.records if segment is not None else None
 
     def get(self, key, default=None):
-        storage = self._storage()
-        if storage is None:
+        records = self._records(key)
+        if records is None:
             return default
-        return storage.get(key, default)
+        return records.get(key, default)
 
     def __getitem__(self, key):
         r = self.get(key)
@@ -59,25 +96,45 @@ class ChangesetView(object):
         return r
 
     def __contains__(self, key):
-        return key in self.keys()
+        try:
+            records = self._records(key)
+            return records is not None and key in records
+        except TypeError:
+            return False  # not an integer key
 
     def __len__(self):
-        return len(self.keys())
+        return sum(s.count() for s in self._segments())
+
+    def counts(self, by=('user',), prefix=()):
+        if isinstance(by, basestring):
+            by = (by,)
+        by = tuple(by)
+        if by not in AGGREGATES:
+            raise ValueError('Records are not counted by %r' % (by,))
+        counts = {}
+        for segment in self._segments():
+            for value, count in segment.counted(by, tuple(prefix)):
+                counts[value] = counts.get(value, 0) + count
+        if len(by) == 1:
+            return dict((value[0], count) for value, count in counts.items())
+        return counts
 
     def keys(self):
-        return (self._keystore() or [])
+        return list(self.iterkeys())
 
     def iterkeys(self):
-        store = self._keystore()
-        if store is None:
-            return iter([])
-        return iter(store)
+        # keys are descending timestamps, so BTree order is LIFO; only
+        # partitions enumerated so far are loaded:
+        return itertools.chain.from_iterable(
+            merge(*[iter(s.records.keys()) for s in partition.values()])
+            for partition in self._partitions()
+            )
 
     def itervalues(self):
-        return itertools.imap(self.get, self.iterkeys())
+        return itertools.imap(operator.itemgetter(1), self.iteritems())
 
     def iteritems(self):
-        return itertools.imap(lambda k: (k, self.get(k)), self.iterkeys())
+        return self._select()
 
     def values(self):
         return list(self.itervalues())
@@ -86,21 +143,99 @@ class ChangesetView(object):
         return list(self.iteritems())
 
     def match(self, filters, record):
+        if self._matches(filters, record):
+            return True
+        # removal of a folder matches if that of any descendant would:
+        manifest = (record.get('extra') or {}).get('descendants')
+        if manifest is None:
+            return False
+        return any(
+            self._matches(filters, descendant)
+            for descendant in manifest.records(record)
+            )
+
+    def _matches(self, filters, record):
         # compare path by prefix...
         if 'path' in filters:
             if not record.get('path', '').startswith(filters['path']):
                 return False
         # ...everything else by exact match
-        for k in (filter, lambda k: k != 'path', filters):
+        for k in filter(lambda k: k != 'path', filters):
             if filters[k] != record.get(k):
                 return False
         return True
 
-    def limit(self, filters=None, start=0):
-        if not filters:
-            return iter(self.keys()[start:])
-        # TODO: indexed filtering, for now, just crawl through the muck
-        return itertools.ifilter(self.match, map(self.get, self.key()))
+    def _select(self, filters=None, after=None, probe=None, since=None,
+                until=None):
+        """
+        (key, record) pairs matching filters, LIFO, after key, logged
+        at or after since and before until (datetimes), if given.
+        """
+        # filters on indexed fields select candidate keys:
+        query = None
+        if filters:
+            query = dict((k, v) for k, v in filters.items() if k in INDEXES)
+        # keys are time-ordered, so a time window is a range of keys,
+        # within a range of partitions:
+        first, last = time_bounds(since, until)
+        items = itertools.chain.from_iterable(
+            merge(*[
+                s.select(query, after, first, last)
+                for s in partition.values()
+                ])
+            for partition in self._partitions(after, first, last)
+            )
+        if probe is not None:
+            items = probe.counted(items, 'scanned')
+        if since is not None or until is not None:
+            # ...only records logged in the milliseconds bounding the
+            # window may fall outside it:
+            items = itertools.ifilter(
+                lambda item: (
+                    (since is None or item[1].get('when') >= since) and
+                    (until is None or item[1].get('when') < until)
+                    ),
+                items
+                )
+        if filters:
+            # ...any remaining filters are matched on candidate records:
+            items = itertools.ifilter(
+                lambda item: self.match(filters, item[1]),
+                items
+                )
+        return items
+
+    def limit(self, filters=None, start=0, expand=False, since=None,
+              until=None):
+        probe = instrument.probe('limit', self.__name__)
+        after = None
+        if isinstance(start, basestring):
+            after, start = decode_cursor(start, filters), 0
+        records = itertools.imap(
+            operator.itemgetter(1),
+            self._select(filters, after, probe, since, until)
+            )
+        records = itertools.islice(records, start, None)
+        if expand:
+            records = expand_descendants(records)
+            if filters:
+                records = itertools.ifilter(
+                    lambda record: self._matches(filters, record),
+                    records
+                    )
+        if probe is not None:
+            records = probe.iterate(records, 'returned')
+        return records
+
+    def batch(self, filters=None, cursor=None, size=20, since=None,
+              until=None):
+        after = decode_cursor(cursor, filters) if cursor else None
+        items = self._select(filters, after, None, since, until)
+        items = list(itertools.islice(items, size))
+        next_cursor = None
+        if len(items) == size:
+            next_cursor = encode_cursor(items[-1][0], filters)
+        return [record for key, record in items], next_cursor
 
 
 class FacilityStorage(ChangesetView):
@@ -110,23 +245,19 @@ class FacilityStorage(ChangesetView):
 
     def __init__(self, context, name):
         super(FacilityStorage, self).__init__(context, name)
-        self.site = context.context
         # Storage state to be created on first insertion, to avoid
         # any possibility of write-on-read situations
         self.storage = None
         self.facility_storage = None
-        self.key_storage = None
 
-    def generate_key(self):
-        while True:
-            minkey, maxkey = (
-                self.family.minint,
-                self.family.maxint
-                )
-            k = random.randrange(minkey, maxkey)
-            keystore = self._facility_keys()
-            if (keystore and k not in keystore) or not keystore:
-                return k
+    def generate_key(self, when, slot):
+        """
+        Key for record logged at datetime 'when' into segment numbered
+        slot: newer records get smaller keys, so that records enumerate in
+        LIFO order.  Keys of records logged in time order are unique by
+        construction for the writer owning the segment.
+        """
+        return key_clock().next_key(when, slot)
 
     def _core_storage(self, create=False):
         return self.context.storage(create)
@@ -138,68 +269,120 @@ class FacilityStorage(ChangesetView):
             facility = storage[self.__name__] = self.family.IO.BTree()
         return facility
 
-    def _facility_keys(self, create=False):
-        storage = self._core_storage(create=create)
-        keyname = u'%s_keys' % self.__name__
-        facility_keys = storage.get(keyname)
-        if facility_keys is None and create:
-            facility_keys = storage[keyname] = PersistentList()
-        return facility_keys
-
     def prep_insert(self):
         if self.storage is None:
             self.storage = self._core_storage(create=True)
         if self.facility_storage is None:
             self.facility_storage = self._facility_mapping(create=True)
-        if self.key_storage is None:
-            self.key_storage = self._facility_keys(create=True)
-        return (self.facility_storage, self.key_storage)
+        return self.facility_storage
+
+    def _partition(self, key):
+        """Partition for record key, created as needed"""
+        partitions = self.prep_insert()
+        number = partition_of(key)
+        partition = partitions.get(number)
+        if partition is None:
+            # all segments are created up-front, so that writers never
+            # concurrently modify the partition itself; only creating
+            # the partition for a new month may conflict.
+            partition = partitions[number] = self.family.IO.BTree()
+            for slot in range(SEGMENTS):
+                partition[slot] = LogSegment(slot)
+        return partition
 
     def _user(self, user=None):
         if user is None:
-            mtool = getToolByName(self.site, 'portal_membership')
-            user = mtool.getAuthenticatedMember().getUserName()
+            user = self.context.current_user()
         return user
 
     def insert(self, content, user, extra):
-        record_storage, keys = self.prep_insert()
-        key = self.generate_key()
-        uid = IUUID(content)
+        path = '/'.join(content.getPhysicalPath())
+        base = aq_base(content)
+        self.insert_change(
+            IUUID(content),
+            path,
+            user,
+            extra,
+            portal_type=getattr(base, 'portal_type', None),
+            serial=getattr(base, '_p_serial', None),
+            )
+
+    def insert_change(self, uid, path, user, extra, when=None,
+                      portal_type=None, serial=None):
+        probe = instrument.probe('insert', self.__name__)
+        slot = writer_slot()
         user = self._user(user)
-        record = {
-            'uid': uid,
-            'path': '/'.join(content.getPhysicalPath()),
-            'user': user,
-            'when': datetime.now()
-            }
-        if extra:
-            record['extra'] = dict(extra)
-        record_storage[key] = record
-        # TODO: need to consider whether there are potential
-        #       conflict resolution issues with using a
-        #       PersistentList without subclassing and
-        #       using _p_resolveConflict on the insertion;
-        #       fear is that some expensive transaction takes
-        #       a long time to retry whole request over
-        #       simple race condition on the insertion order
-        #       in the PersistentList used here?
-        keys.insert(0, key)
+        when = when or datetime.now()
+        record = ChangeRecord.create(
+            uid,
+            path,
+            user,
+            when,
+            extra,
+            portal_type,
+            self.context.transaction_marker(),
+            serial,
+            )
+        # Time-ordered key: insertion only touches the newest bucket of
+        # the segment owned by this writer, so concurrent transactions
+        # do not conflict.  Records are keyed (and partitioned) by the
+        # time they were logged at, even if backdated.
+        key = self.generate_key(when, slot)
+        while True:
+            segment = self._partition(key)[slot]
+            if segment.records.insert(key, record):
+                break
+            # Only if key is taken by a record logged in the same
+            # millisecond earlier (e.g. backdated), by another process
+            # sharing the slot, or by this one before a restart:
+            key = key_clock().next_after(key)
+        segment.index(key, record)
+        segment.count.change(1)
+        self.context.backend.add_marker(record.marker, key)
+        if probe is not None:
+            probe.count('bytes', len(cPickle.dumps(record, 1)))
+            probe.done()
 
     def __delitem__(self, key):
-        store = self._facility_mapping()
-        keystore = self._facility_keys()
-        if store is None or keystore is None:
+        if self._facility_mapping() is None:
             raise KeyError('Key not in (empty, uninitialized) store')
-        if key not in store or key not in keystore:
+        if key not in self:
             raise KeyError('Key not in store')
-        keystore.remove(key)
-        del(store[key])
+        segment = self._segment(key)
+        segment.unindex(key, segment.records[key])
+        del(segment.records[key])
+        segment.count.change(-1)
+
+    def prune(self, timespec, limit=None):
+        """
+        Remove (at most limit) records logged before timespec, return
+        number of records removed.  Partitions for months before that
+        of timespec are removed whole, in O(1) (regardless of limit).
+        """
+        partitions = self._storage()
+        if partitions is None:
+            return 0
+        removed = 0
+        current = month_partition(timespec)
+        for number in list(partitions.keys(min=current, excludemin=True)):
+            removed += sum(s.count() for s in partitions[number].values())
+            del(partitions[number])
+        stamp = epoch_ms(timespec)
+        partition = partitions.get(current)
+        segments = partition.values() if partition is not None else ()
+        for segment in segments:
+            if limit is not None and removed >= limit:
+                break
+            remaining = None if limit is None else limit - removed
+            removed += segment.prune(timespec, stamp, remaining)
+        return removed
 
 
 class ModificationLogger(object):
     """
     Adapter of site, fronts for logging to annotation-based storage
-    using OOTB data types.
+    using OOTB data types, or to storage in a separate database, if
+    configured (see backends).
     """
 
     implements(IModificationLogger)
@@ -211,24 +394,71 @@ class ModificationLogger(object):
         'move': u'moves',
     }
 
-    def __init__(self, site=None):
+    def __init__(self, site=None, database=None):
         if site is None:
             site = getSite()
         self.context = site
-        # Facilities initially uninitialized:
-        self._facilities = {}
+        self.backend = storage_backend(site, database)
+        # Facilities, storage and user initially uninitialized, then
+        # cached until the end of the current transaction:
+        self._txn = None
+        self._cached()
+
+    def _transaction(self):
+        jar = getattr(self.context, '_p_jar', None)
+        if jar is not None:
+            return jar.transaction_manager.get()
+        return transaction.get()
+
+    def _cached(self):
+        """Drop cached state on transaction boundaries"""
+        txn = self._transaction()
+        if txn is not self._txn:
+            self._txn = txn
+            self._facilities = {}
+            self._storage = None
+            self._user = None
+            self._marker = None
 
     def storage(self, create=False):
-        anno = IAnnotations(self.context)
-        storage = anno.get(ANNO_KEY)
-        if not storage and create:
-            storage = anno[ANNO_KEY] = PersistentMapping()
-        return storage
+        self._cached()
+        if self._storage is None:
+            self._storage = self.backend.get(create)
+        return self._storage
+
+    def transaction_marker(self):
+        """
+        Marker shared by records logged in the current transaction, its
+        serial becoming the tid of the transaction once committed.
+        """
+        self._cached()
+        if self._marker is None:
+            self._marker = TransactionMarker()
+        return self._marker
+
+    def current_user(self):
+        """User name of authenticated member"""
+        self._cached()
+        if self._user is None:
+            mtool = getToolByName(self.context, 'portal_membership')
+            self._user = mtool.getAuthenticatedMember().getUserName()
+        return self._user
 
     def log(self, action, content, user=None, extra=None):
         name = self.ACTION_FACILITIES.get(action) or unicode(action)
-        facility = FacilityStorage(self, name)
-        facility.insert(content, user, extra)
+        probe = instrument.probe('log', name)
+        self._facility(name).insert(content, user, extra)
+        if probe is not None:
+            probe.done()
+
+    def log_change(self, action, uid, path, user=None, extra=None,
+                   when=None, portal_type=None, serial=None):
+        name = self.ACTION_FACILITIES.get(action) or unicode(action)
+        probe = instrument.probe('log', name)
+        self._facility(name).insert_change(
+            uid, path, user, extra, when, portal_type, serial)
+        if probe is not None:
+            probe.done()
 
     def modified(self, content, user=None, extra=None):
         self.log('modify', content, user, extra)
@@ -243,6 +473,7 @@ class ModificationLogger(object):
         self.log('delete', content, user, extra)
 
     def _facility(self, key):
+        self._cached()
         if self._facilities.get(key) is None:
             self._facilities[key] = FacilityStorage(self, key)
         return self._facilities[key]
@@ -263,23 +494,52 @@ class ModificationLogger(object):
     def additions(self):
         return self._facility('additions')
 
-    def _prune(self, name, timespec):
-        # now begins the long slog through unindexed records...
-        facility = self._facility(name)
-        result = filter(
-            lambda p: p[1].get('when') < timespec,
-            list(facility.items())
-            )
-        for (key, record) in result:
-            del(facility[key])
-
-    def prune(self, facility=None, days=None, timespec=None):
+    def _prune_spec(self, facility, days, timespec):
         if days is None and timespec is None:
             raise ValueError('Unspecified modification log pruning time')
         facilities = self.ACTION_FACILITIES.values()
         facilities = facilities if facility is None else (facility,)
         if days is not None:
             timespec = datetime.now() - timedelta(days=float(days))
-        for name in facilities:
-            self._prune(name, timespec)
+        names = [self.ACTION_FACILITIES.get(n, n) for n in facilities]
+        return names, timespec
+
+    def _prune(self, name, timespec, limit=None):
+        probe = instrument.probe('prune', name)
+        removed = self._facility(name).prune(timespec, limit)
+        if probe is not None:
+            probe.count('removed', removed)
+            probe.done()
+        return removed
+
+    def _prune_markers(self, timespec):
+        """
+        Remove markers of transactions kept apart from records (if any),
+        for months before that of timespec, once all facilities are
+        pruned to timespec: only records logged before them refer to
+        them.
+        """
+        return self.backend.prune_markers(timespec)
+
+    def prune(self, facility=None, days=None, timespec=None):
+        names, timespec = self._prune_spec(facility, days, timespec)
+        result = dict((name, self._prune(name, timespec)) for name in names)
+        if facility is None:
+            removed = self._prune_markers(timespec)
+            if removed:
+                result[MARKERS] = removed
+        return result
+
+    def iterprune(self, facility=None, days=None, timespec=None, chunk=1000):
+        names, timespec = self._prune_spec(facility, days, timespec)
+        for name in names:
+            while True:
+                removed = self._prune(name, timespec, chunk)
+                if not removed:
+                    break
+                yield name, removed
+        if facility is None:
+            removed = self._prune_markers(timespec)
+            if removed:
+                yield MARKERS, removed
 
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends for modification logs.
+
+By default, a site's modification log is kept in an annotation of the
+site root, in the main database.  It may instead be kept in a separate
+database, so that log churn does not share the cache, pack cycle and
+conflicts of content.  In zope.conf, add a database, and name it in
+product configuration for plone.wabac:
+
+    <zodb_db modlog>
+        <filestorage>
+            path $INSTANCE/var/filestorage/modlog.fs
+        </filestorage>
+        mount-point /modlog
+    </zodb_db>
+
+    <product-config plone.wabac>
+        modlog-database modlog
+    </product-config>
+
+The database is reached as a connection of the multi-database of the
+site's connection, and keeps logs for all sites, keyed by site path.
+
+Records reference a marker of the transaction logging them, the serial
+of which becomes the tid of the transaction once committed (see
+records).  Markers are stored in the site's database, so that this is
+the tid of the transaction there, to read content from: along with
+records in annotations, or, with records in a separate database, in an
+annotation of the site of their own, partitioned by month and writer
+slot (as records are, so that writers do not conflict) of the newest
+record referring to them, and removed by whole months once all
+facilities are pruned.
+"""
+
+from BTrees.IOBTree import IOBTree
+from BTrees.LOBTree import LOBTree
+from BTrees.OOBTree import OOBTree
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+
+from config import product_config
+from keys import following, month_partition, partition_of, slot_of
+from segments import SEGMENTS
+
+
+ANNO_KEY = 'plone.wabac.modlog'
+
+MARKERS_KEY = 'plone.wabac.modlog.markers'
+
+DATABASE_KEY = 'modlog-database'
+
+
+def configured_database():
+    """Name of database configured for logs, or None (annotations)"""
+    return product_config(DATABASE_KEY)
+
+
+class AnnotationStorage(object):
+    """Log storage in annotation of site (default)"""
+
+    def __init__(self, site):
+        self.site = site
+
+    def get(self, create=False):
+        anno = IAnnotations(self.site)
+        storage = anno.get(ANNO_KEY)
+        if storage is None and create:
+            storage = anno[ANNO_KEY] = PersistentMapping()
+        return storage
+
+    def add_marker(self, marker, key):
+        """Markers are stored with the records referencing them"""
+
+    def prune_markers(self, timespec):
+        return 0
+
+
+class DatabaseStorage(object):
+    """Log storage in root of named database, keyed by site path"""
+
+    def __init__(self, site, name):
+        self.site = site
+        self.name = name
+
+    def connection(self):
+        jar = self.site._p_jar
+        if jar is None:
+            raise ValueError('Site is not stored in a database')
+        return jar.get_connection(self.name)
+
+    def get(self, create=False):
+        root = self.connection().root()
+        sites = root.get(ANNO_KEY)
+        if sites is None:
+            if not create:
+                return None
+            sites = root[ANNO_KEY] = OOBTree()
+        key = '/'.join(self.site.getPhysicalPath())
+        storage = sites.get(key)
+        if storage is None and create:
+            storage = sites[key] = PersistentMapping()
+        return storage
+
+    def markers(self, create=False):
+        """
+        Transaction markers in the site's database: mapping of monthly
+        partition numbers to mappings of writer slots to markers by key.
+        """
+        anno = IAnnotations(self.site)
+        markers = anno.get(MARKERS_KEY)
+        if markers is None and create:
+            markers = anno[MARKERS_KEY] = IOBTree()
+        return markers
+
+    def add_marker(self, marker, key):
+        """
+        Store marker of the current transaction in site's database, as
+        referred to by record at key: in the partition of the newest
+        record referring to it, so that it is kept as long as records
+        referring to it are.
+        """
+        stored = getattr(marker, '_v_key', None)
+        if stored is not None and partition_of(stored) <= partition_of(key):
+            return  # (newer partitions have smaller numbers)
+        partitions = self.markers(create=True)
+        if stored is None:
+            self.site._p_jar.add(marker)  # not in that of records
+        else:
+            del(partitions[partition_of(stored)][slot_of(stored)][stored])
+        partition = partitions.get(partition_of(key))
+        if partition is None:
+            partition = partitions[partition_of(key)] = IOBTree()
+            for number in range(SEGMENTS):
+                partition[number] = LOBTree()
+        # (only markers of records logged in the same millisecond by
+        # other facilities may take the key):
+        while not partition[slot_of(key)].insert(key, marker):
+            key = -following(-key)
+        marker._v_key = key
+
+    def prune_markers(self, timespec):
+        """
+        Remove markers of months before that of timespec, return number
+        of markers removed.
+        """
+        partitions = self.markers()
+        if partitions is None:
+            return 0
+        removed = 0
+        current = month_partition(timespec)
+        for number in list(partitions.keys(min=current, excludemin=True)):
+            removed += sum(len(m) for m in partitions[number].values())
+            del(partitions[number])
+        return removed
+
+
+def storage_backend(site, database=None):
+    """
+    Backend for log of site: in named database, if given or configured,
+    otherwise in annotation of site.
+    """
+    database = database or configured_database()
+    if database:
+        return DatabaseStorage(site, database)
+    return AnnotationStorage(site)
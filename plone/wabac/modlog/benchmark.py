@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of modification log insert, query and prune at scale, on
+stand-in content in a local MappingStorage or FileStorage database.
+
+Run with the Python of a Zope instance, for example:
+
+    bin/zopepy src/plone.wabac/plone/wabac/modlog/benchmark.py \\
+        --sizes 10000 100000 --storage file --save baseline.json
+
+and later, to compare a run against saved results:
+
+    bin/zopepy src/plone.wabac/plone/wabac/modlog/benchmark.py \\
+        --sizes 10000 100000 --storage file --compare baseline.json
+
+Each size is benchmarked in a process of its own, so that peak memory
+is measured for that size alone.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import transaction
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+
+from plone.wabac.modlog import ModificationLogger
+from plone.wabac.modlog.testing import provide_adapters, stand_in_database
+
+
+SIZES = (10000, 100000, 1000000)
+
+# Distinct users, folders and content items logged:
+USERS = 50
+
+FOLDERS = 100
+
+ITEMS = 10000
+
+# Records are logged at times spread over this many days, before now:
+SPAN_DAYS = 90
+
+PAGE = 20
+
+
+def _timed(fn, *args):
+    began = time.time()
+    result = fn(*args)
+    return time.time() - began, result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _storage(kind, directory):
+    if kind == 'file':
+        return FileStorage(os.path.join(directory, 'Data.fs'))
+    return MappingStorage()
+
+
+def run(size, kind='mapping', batch=1000, repeat=5):
+    """Benchmark size records on storage kind, return ordered results"""
+    provide_adapters()
+    directory = tempfile.mkdtemp()
+    storage = _storage(kind, directory)
+    db, oid = stand_in_database(storage)
+    results = OrderedDict()
+    try:
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        logger = ModificationLogger(conn.get(oid))
+        facility = logger.modifications
+        users = ['user%s' % i for i in range(USERS)]
+        items = [
+            (uuid.uuid4().hex, '/plone/folder%s/page%s' % (i % FOLDERS, i))
+            for i in range(ITEMS)
+            ]
+        start = datetime.now() - timedelta(days=SPAN_DAYS)
+        step = timedelta(days=SPAN_DAYS) / size
+
+        def insert():
+            for i in range(size):
+                uid, path = items[i % ITEMS]
+                user = users[i % USERS]
+                facility.insert_change(uid, path, user, None, start + step * i)
+                if not (i + 1) % batch:
+                    tm.commit()
+            tm.commit()
+
+        initial = storage.getSize()
+        conn.getTransferCounts(True)
+        elapsed, _ = _timed(insert)
+        commits = (size + batch - 1) // batch
+        results['insert (records/s)'] = size / elapsed
+        results['commit size (bytes/record)'] = (
+            float(storage.getSize() - initial) / size
+            )
+        stores = conn.getTransferCounts(True)[1]
+        results['objects stored per commit'] = float(stores) / commits
+
+        uid, path = items[7]
+        queries = OrderedDict([
+            ('newest page', None),
+            ('by user', {'user': users[3]}),
+            ('by uid', {'uid': uid}),
+            ('by path', {'path': '/plone/folder7/'}),
+            ])
+        for name, filters in queries.items():
+            for state in ('cold', 'warm'):
+                times = []
+                for i in range(repeat):
+                    if state == 'cold':
+                        conn.cacheMinimize()
+                    page = itertools.islice(facility.limit(filters), PAGE)
+                    times.append(_timed(list, page)[0])
+                key = 'limit %s, %s (ms)' % (name, state)
+                results[key] = _median(times) * 1000
+        conn.cacheMinimize()
+        results['len, cold (ms)'] = _timed(len, facility)[0] * 1000
+
+        conn.cacheMinimize()
+        elapsed, _ = _timed(lambda: sum(1 for r in facility.itervalues()))
+        results['full enumeration (records/s)'] = size / elapsed
+        cache = conn._cache
+        results['cache objects after enumeration'] = (
+            cache.cache_non_ghost_count
+            )
+        results['cache size after enumeration (MB)'] = (
+            cache.total_estimated_size / 1048576.0
+            )
+        conn.cacheMinimize()
+
+        def prune():
+            removed = facility.prune(start + timedelta(days=SPAN_DAYS / 2))
+            tm.commit()
+            return removed
+
+        elapsed, removed = _timed(prune)
+        results['prune half (s)'] = elapsed
+        results['prune half (records/s)'] = removed / elapsed
+        results['peak RSS (MB)'] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            )
+        conn.close()
+    finally:
+        db.close()
+        shutil.rmtree(directory)
+    return results
+
+
+def _run_isolated(size, kind, batch, repeat):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run, (size, kind, batch, repeat))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def table(results, baseline=None):
+    """
+    Text table of results: rows are metrics, columns are sizes; with
+    baseline results, each value is followed by its relative change.
+    """
+    sizes = sorted(results, key=int)
+    metrics = results[sizes[0]].keys()
+    width = max(len(m) for m in metrics) + 2
+    column = max(len('%s records' % s) for s in sizes) + 3
+    column += 8 if baseline else 0
+    lines = [
+        'metric'.ljust(width) +
+        ''.join(('%s records' % s).rjust(column) for s in sizes)
+        ]
+    for metric in metrics:
+        cells = []
+        for size in sizes:
+            value = results[size][metric]
+            cell = '%.1f' % value
+            before = (baseline or {}).get(size, {}).get(metric)
+            if before:
+                cell += ' (%+.0f%%)' % ((value - before) * 100.0 / before)
+            cells.append(cell.rjust(column))
+        lines.append(metric.ljust(width) + ''.join(cells))
+    return '\n'.join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark plone.wabac modification logs.'
+        )
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=SIZES,
+        help='Numbers of records to benchmark',
+        )
+    parser.add_argument(
+        '--storage',
+        choices=('mapping', 'file'),
+        default='mapping',
+        help='Storage: in-memory MappingStorage, or temporary FileStorage',
+        )
+    parser.add_argument(
+        '--batch',
+        type=int,
+        default=1000,
+        help='Records inserted per transaction',
+        )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Runs of each query timed (median is reported)',
+        )
+    parser.add_argument('--save', help='Save results to JSON file')
+    parser.add_argument('--compare', help='Compare to results in JSON file')
+    args = parser.parse_args(argv)
+    results = OrderedDict()
+    for size in args.sizes:
+        results[size] = _run_isolated(
+            size, args.storage, args.batch, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f, object_pairs_hook=OrderedDict)
+        baseline = dict((int(k), v) for k, v in saved.items())
+    print(table(results, baseline))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
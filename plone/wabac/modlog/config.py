@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Product configuration (zope.conf) for modification logs, e.g.:
+
+    <product-config plone.wabac>
+        modlog-database modlog
+    </product-config>
+"""
+
+try:
+    from App.config import getConfiguration
+except ImportError:  # plain ZODB, e.g. stand-in testing
+    getConfiguration = None
+
+
+PRODUCT_NAME = 'plone.wabac'
+
+
+def product_config(key, default=None):
+    """Value of key in plone.wabac product configuration, or default"""
+    if getConfiguration is None:
+        return default
+    config = getattr(getConfiguration(), 'product_config', None) or {}
+    return (config.get(PRODUCT_NAME) or {}).get(key) or default
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of modification log records, as JSON lines or CSV.
+
+Records are exported in chunks, as an iterator of strings, so that a
+whole facility can be written out (e.g. to a response) in constant
+memory; a callback after each chunk may drop loaded records from the
+ZODB cache.
+"""
+
+from cStringIO import StringIO
+from datetime import datetime
+
+import binascii
+import csv
+import itertools
+import json
+
+
+FIELDS = (
+    'uid',
+    'path',
+    'user',
+    'when',
+    'extra',
+    'portal_type',
+    'tid',
+    'serial',
+    )
+
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    }
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+
+
+def parse_time(value):
+    """Naive datetime from ISO 8601 date or date and time string"""
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError('Unrecognized date/time: %r' % value)
+
+
+def _hex(value):
+    return binascii.hexlify(value) if value is not None else None
+
+
+def export_values(record):
+    """
+    Mapping of field names to JSON-compatible values of record (tid and
+    serial are hexadecimal)
+    """
+    extra = dict(record.get('extra') or {})
+    manifest = extra.pop('descendants', None)
+    if manifest is not None:
+        extra['descendants'] = len(manifest)  # count, not manifest
+    return {
+        'uid': record.get('uid'),
+        'path': record.get('path'),
+        'user': record.get('user'),
+        'when': record.get('when').isoformat(),
+        'extra': extra or None,
+        'portal_type': record.get('portal_type'),
+        'tid': _hex(record.get('tid')),
+        'serial': _hex(record.get('serial')),
+        }
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def jsonl_lines(records):
+    for record in records:
+        yield json.dumps(export_values(record), default=unicode) + '\n'
+
+
+def csv_lines(records):
+    out = StringIO()
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    yield out.getvalue()
+    out.seek(0)
+    out.truncate()
+    for record in records:
+        values = export_values(record)
+        if values['extra'] is not None:
+            values['extra'] = json.dumps(values['extra'], default=unicode)
+        writer.writerow([_encode(values[name]) for name in FIELDS])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+def export_chunks(records, format='jsonl', size=1000, after_chunk=None):
+    """
+    Iterate chunks (strings) of records exported in format ('jsonl' or
+    'csv'), of at most size records each.  Optional after_chunk callable
+    is called once each chunk has been consumed.
+    """
+    lines = {'jsonl': jsonl_lines, 'csv': csv_lines}[format](records)
+    while True:
+        chunk = ''.join(itertools.islice(lines, size))
+        if not chunk:
+            break
+        yield chunk
+        if after_chunk is not None:
+            after_chunk()
@@ -1,20 +1,269 @@
 # -*- coding: utf-8 -*-
+"""
+Event subscribers logging content changes.
+
+Changes are not written to the modification log as events happen, but
+queued for the current transaction, coalesced per content UID, and
+written once, by a before-commit hook:
+
+- an item added in the transaction is logged once, as added, at its
+  final path (subsuming any renames/moves and modifications);
+- an item both added and deleted in the transaction is not logged;
+- repeated modifications (or moves) are logged once, the latest path
+  winning;
+- deletion subsumes modifications and moves of the deleted item;
+- removal of a folder is logged as one deletion record for the folder,
+  with a manifest of the descendants removed with it, rather than one
+  record per descendant.
+
+Changes are attributed to the user authenticated when committing, and
+recorded with the serial of content as last committed before them.
+
+The queue joins the transaction as a data manager: changes rolled back
+to a savepoint are rolled back in the queue too, and the queue is
+cleared when the transaction aborts.  Changes queued after the queue
+was flushed (e.g. by other before-commit hooks) are flushed by another
+hook; changes made once the transaction is committing cannot be
+logged any more, and are reported as a warning.
+
+The queue also keeps one logger per site for its transaction, so that
+facilities, storage and user are looked up once per transaction, not
+once per event; it is discarded when the transaction ends.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import threading
+
+from Acquisition import aq_base
+from plone.uuid.interfaces import IUUID
+from transaction.interfaces import IDataManagerSavepoint
+from transaction.interfaces import ISavepointDataManager
+from zope.component.hooks import getSite
+from zope.interface import implements
 from zope.lifecycleevent.interfaces import IObjectAddedEvent
 from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+import transaction
 
 from Products.CMFCore.interfaces import ISiteRoot
 
 from plone.wabac.modlog import ModificationLogger
+from plone.wabac.modlog.records import ChildManifest
+
+
+log = logging.getLogger('plone.wabac.modlog')
+
+
+def copy_sites(sites):
+    """Copy of queued changes, sharing only immutable values"""
+    return dict(
+        (key, (
+            site,
+            OrderedDict(
+                (uid, OrderedDict(entry)) for uid, entry in changes.items()
+                ),
+            dict(
+                (uid, OrderedDict(descendants))
+                for uid, descendants in subtrees.items()
+                ),
+            ))
+        for key, (site, changes, subtrees) in sites.items()
+        )
+
+
+class QueueSavepoint(object):
+    """Snapshot of a change queue, restored on savepoint rollback"""
+
+    implements(IDataManagerSavepoint)
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.sites = copy_sites(queue.sites)
+
+    def rollback(self):
+        # copy again: a savepoint may be rolled back to more than once
+        self.queue.sites = copy_sites(self.sites)
+
+
+class ChangeQueue(object):
+    """Changes made in one transaction, pending logging"""
+
+    implements(ISavepointDataManager)
+
+    def __init__(self, txn):
+        self.txn = txn
+        self.transaction_manager = transaction.manager
+        self.scheduled = False  # flush registered as before-commit hook
+        self.committing = False
+        # id(site) -> (site, OrderedDict of uid -> OrderedDict of
+        #                  action -> (path, when, portal_type, serial),
+        #              dict of removed folder uid -> OrderedDict of
+        #                  descendant uid -> path)
+        self.sites = {}
+        # id(site) -> ModificationLogger, for this transaction only
+        self.loggers = {}
+
+    def schedule(self, content):
+        """Ensure queued changes are flushed before commit"""
+        if self.committing:
+            log.warning(
+                'Change to %s made while committing, not logged',
+                '/'.join(content.getPhysicalPath()),
+                )
+            return False
+        if not self.scheduled:
+            self.txn.addBeforeCommitHook(self.flush)
+            self.scheduled = True
+        return True
+
+    def record(self, action, content):
+        site = getSite()
+        uid = IUUID(content, None)
+        if site is None or uid is None or not self.schedule(content):
+            return
+        path = '/'.join(content.getPhysicalPath())
+        portal_type = getattr(aq_base(content), 'portal_type', None)
+        serial = getattr(aq_base(content), '_p_serial', None)
+        changes = self._changes(site)[1]
+        entry = changes.setdefault(uid, OrderedDict())
+        if 'add' in entry:
+            if action == 'delete':
+                # added, then deleted, never committed: nothing to log
+                del(entry['add'])
+                if not entry:
+                    del(changes[uid])
+            else:
+                entry['add'] = (path, entry['add'][1], portal_type, None)
+            return
+        if action == 'delete':
+            entry.pop('modify', None)
+            entry.pop('move', None)
+        entry.pop(action, None)  # re-insert as latest
+        entry[action] = (path, datetime.now(), portal_type, serial)
+
+    def _changes(self, site):
+        key = id(site)
+        if key not in self.sites:
+            self.sites[key] = (site, OrderedDict(), {})
+        return self.sites[key]
+
+    def record_descendant(self, content, root):
+        """Queue removal of content along with removed folder root"""
+        site = getSite()
+        uid = IUUID(content, None)
+        root_uid = IUUID(root, None)
+        if site is None or uid is None or not self.schedule(content):
+            return
+        if root_uid is None:
+            self.record('delete', content)
+            return
+        site, changes, subtrees = self._changes(site)
+        entry = changes.pop(uid, None)
+        if entry is not None and 'add' in entry:
+            return  # added, then deleted, never committed
+        path = '/'.join(content.getPhysicalPath())
+        subtrees.setdefault(root_uid, OrderedDict())[uid] = path
+
+    def logger(self, site):
+        logger = self.loggers.get(id(site))
+        if logger is None:
+            logger = self.loggers[id(site)] = ModificationLogger(site)
+        return logger
+
+    def flush(self):
+        sites, self.sites = self.sites, {}
+        self.scheduled = False
+        for site, changes, subtrees in sites.values():
+            logger = self.logger(site)
+            for uid, entry in changes.items():
+                for action, values in entry.items():
+                    path, when, portal_type, serial = values
+                    extra = None
+                    if action == 'delete' and uid in subtrees:
+                        descendants = subtrees.pop(uid)
+                        extra = {
+                            'descendants': ChildManifest(path, descendants),
+                            }
+                    logger.log_change(
+                        action,
+                        uid,
+                        path,
+                        None,
+                        extra,
+                        when,
+                        portal_type,
+                        serial,
+                        )
+            # descendants of folders not logged as removed (e.g. added
+            # in this transaction) are logged individually:
+            when = datetime.now()
+            for descendants in subtrees.values():
+                for uid, path in descendants.items():
+                    logger.log_change('delete', uid, path, when=when)
+
+    # data manager, for savepoints and abort; logging itself is written
+    # by the connections of the sites logged to:
+
+    def savepoint(self):
+        return QueueSavepoint(self)
+
+    def abort(self, txn):
+        self.sites = {}
+
+    def tpc_begin(self, txn):
+        self.committing = True
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        self.sites = {}
+
+    def tpc_abort(self, txn):
+        self.sites = {}
+
+    def sortKey(self):
+        return 'plone.wabac.modlog.handlers:%d' % id(self)
+
+
+_local = threading.local()
+
+
+def queue():
+    """Change queue for the current transaction"""
+    txn = transaction.get()
+    current = getattr(_local, 'queue', None)
+    if current is None or current.txn is not txn:
+        current = _local.queue = ChangeQueue(txn)
+        try:
+            txn.join(current)
+        except ValueError:
+            # first change made while committing: too late to log it
+            current.committing = True
+    return current
+
+
+def flush():
+    """Log changes queued in the current transaction immediately"""
+    queue().flush()
 
 
 def log_modified(context, event):
-    ModificationLogger().modified(context)
+    queue().record('modify', context)
 
 
 def log_deleted(context, event):
     if ISiteRoot.providedBy(event.object):
         return
-    ModificationLogger().deleted(context)
+    if event.object is not context:
+        # descendant of removed folder (event dispatched to sublocations)
+        queue().record_descendant(context, event.object)
+        return
+    queue().record('delete', context)
 
 
 def log_moved(context, event):
@@ -22,9 +271,8 @@ def log_moved(context, event):
     is_add = IObjectAddedEvent.providedBy(event)
     if is_add or is_remove:
         return
-    ModificationLogger().moved(context)
+    queue().record('move', context)
 
 
 def log_added(context, event):
-    ModificationLogger().added(context)
-
+    queue().record('add', context)
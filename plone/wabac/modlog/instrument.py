@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Optional instrumentation of modification logging, querying and pruning.
+
+Instrumented calls (log, insert, limit, prune) report, per facility,
+their duration and counts (e.g. records scanned and returned by limit,
+bytes of records inserted, records pruned) to pluggable sinks:
+
+- LoggingSink, to the Python logging module;
+- StatsdSink, as statsd metrics over UDP;
+- RegistrySink, accumulating totals in-process (see registry, shown by
+  the @@modlog-stats view).
+
+Without sinks, instrumented calls only pay for checking that there are
+none.  Sinks are added with add_sink(), or configured in zope.conf:
+
+    <product-config plone.wabac>
+        modlog-instrument logging statsd registry
+        modlog-statsd localhost:8125
+    </product-config>
+"""
+
+import copy
+import logging
+import socket
+import threading
+import time
+
+from config import product_config
+
+
+class LoggingSink(object):
+    """Log each instrumented call"""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('plone.wabac.modlog')
+        self.level = level
+
+    def emit(self, name, facility, duration, counts):
+        self.logger.log(
+            self.level,
+            'modlog %s %s: %.3f ms %s',
+            facility,
+            name,
+            duration * 1000,
+            ' '.join('%s=%s' % item for item in sorted(counts.items())),
+            )
+
+
+class StatsdSink(object):
+    """
+    Send statsd timing and counter metrics over UDP, named
+    prefix.facility.call (e.g. plone.wabac.modlog.deletions.insert).
+    """
+
+    def __init__(self, host='localhost', port=8125,
+                 prefix='plone.wabac.modlog'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, name, facility, duration, counts):
+        base = '%s.%s.%s' % (self.prefix, facility, name)
+        lines = ['%s:%d|ms' % (base, duration * 1000), '%s.calls:1|c' % base]
+        lines.extend(
+            '%s.%s:%d|c' % (base, key, value)
+            for key, value in counts.items()
+            )
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass  # metrics are best-effort
+
+
+class RegistrySink(object):
+    """
+    In-process totals per (facility, call): number of calls, total and
+    maximum duration (seconds), and totals of counts.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def emit(self, name, facility, duration, counts):
+        with self.lock:
+            stats = self.stats.setdefault(
+                (facility, name),
+                {'calls': 0, 'time': 0.0, 'max': 0.0},
+                )
+            stats['calls'] += 1
+            stats['time'] += duration
+            stats['max'] = max(stats['max'], duration)
+            for key, value in counts.items():
+                stats[key] = stats.get(key, 0) + value
+
+    def snapshot(self):
+        """Copy of totals, as mapping of (facility, call) to totals"""
+        with self.lock:
+            return copy.deepcopy(self.stats)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+# In-process registry, used when configured as 'registry':
+registry = RegistrySink()
+
+_sinks = None
+
+
+def _configured():
+    sinks = []
+    names = (product_config('modlog-instrument') or '').split()
+    if 'logging' in names:
+        sinks.append(LoggingSink())
+    if 'statsd' in names:
+        address = product_config('modlog-statsd', 'localhost:8125')
+        sinks.append(StatsdSink(*address.split(':')))
+    if 'registry' in names:
+        sinks.append(registry)
+    return sinks
+
+
+def sinks():
+    """Sinks in use, initially as configured"""
+    global _sinks
+    if _sinks is None:
+        _sinks = _configured()
+    return _sinks
+
+
+def add_sink(sink):
+    if sink not in sinks():
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    if sink in sinks():
+        _sinks.remove(sink)
+
+
+class Probe(object):
+    """Duration and counts of one instrumented call"""
+
+    def __init__(self, name, facility):
+        self.name = name
+        self.facility = facility
+        self.counts = {}
+        self.started = time.time()
+        self.duration = None
+
+    def count(self, key, value=1):
+        self.counts[key] = self.counts.get(key, 0) + value
+
+    def done(self):
+        """Stop timing (if not stopped), emit to sinks"""
+        if self.duration is None:
+            self.duration = time.time() - self.started
+        for sink in sinks():
+            sink.emit(self.name, self.facility, self.duration, self.counts)
+
+    def counted(self, iterable, key):
+        """Iterate iterable, counting items as key"""
+        for item in iterable:
+            self.count(key)
+            yield item
+
+    def iterate(self, iterable, key):
+        """
+        Iterate iterable, counting items as key and timing only the time
+        spent producing items; emit once exhausted or closed.
+        """
+        self.duration = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                began = time.time()
+                try:
+                    item = next(iterator)
+                finally:
+                    self.duration += time.time() - began
+                self.count(key)
+                yield item
+        except StopIteration:
+            pass
+        finally:
+            self.done()
+
+
+def probe(name, facility):
+    """Probe for an instrumented call, or None without sinks"""
+    if not sinks():
+        return None
+    return Probe(name, facility)
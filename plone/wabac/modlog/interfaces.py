@@ -23,16 +23,67 @@ class IChangeEnumeration(IIterableMapping, ILocation):
     may not be idemopotent, and could cause unanticipated database writes.
     """
 
-    def limit(filters=None, start=0):
+    def limit(filters=None, start=0, expand=False, since=None, until=None):
         """
         Return an iterator of records in LIFO order matching filters,
         which should be provided as a mapping.
 
         If filters is None, return equivalent to itervalues().
 
+        Filters are matched exactly against record values, except for
+        'path', which is matched as a path prefix.  Filters on 'uid',
+        'user' and 'path' are answered from indexes, loading only
+        matching records.
+
         To use for batching, callers should pass batch start index
         using the 'start' argument, iterating through only the batch size,
         as needed.  Start is zero-indexed.
+
+        Start may alternately be a cursor string as returned by batch(),
+        to resume enumeration after the last record of a previous batch.
+
+        If since or until (datetimes) are given, only records logged at
+        or after since, and before until, are enumerated (by their time
+        'when', backdated or not).  Keys are ordered by that time, so the
+        window is scanned as a range of keys (with any filters): records
+        outside it are not loaded.
+
+        Removal of a folder is logged as one record, with the UIDs and
+        paths of its removed descendants in a manifest (extra metadata
+        'descendants'), and found by them too: filters match the record
+        if they match the folder or any of its descendants.  If expand is
+        true, each such record is followed by a record for each
+        descendant (extra 'ancestor' is the folder UID), loaded lazily,
+        and filters apply to the records expanded, e.g. filtering by the
+        UID of a descendant returns the record of its own removal; start
+        applies to logged records only.
+        """
+
+    def counts(by=('user',), prefix=()):
+        """
+        Return mapping of values to numbers of records, counted by the
+        field or tuple of fields 'by', one of: 'user', 'day' (ISO 8601
+        date logged), 'portal_type', ('user', 'day') or ('portal_type',
+        'day'); for a tuple, values are tuples.  If prefix (a tuple) is
+        given, only values starting with prefix are counted, e.g.
+        counts(('user', 'day'), ('bob',)) for records by user per day.
+
+        Counts are maintained as records are logged and pruned, so are
+        read without loading records.  They count records as logged:
+        removal of a folder counts once, however many descendants were
+        removed with it (as enumerated by limit() with expand).
+        """
+
+    def batch(filters=None, cursor=None, size=20, since=None, until=None):
+        """
+        Return a tuple of (list of at most 'size' records matching filters,
+        logged within since and until, as for limit(), cursor for the next
+        batch or None if this batch is known to be the last).
+
+        Cursors are opaque strings, resuming after the last record of the
+        previous batch in O(log n), rather than skipping an offset; batches
+        are stable while newer records are logged.  A cursor is only valid
+        for the filters it was made with; otherwise ValueError is raised.
         """
 
 
@@ -108,6 +159,22 @@ class IModificationLogger(Interface):
 
         If extra metadata is provided as a dict or mapping, such metadata
         will be stored on the change record logged.
+
+        Records also keep the serial (_p_serial) of content when logged,
+        and, once committed, the tid of the transaction logging them (as
+        'serial' and 'tid'), locating states of content before and after
+        the change in database history.
+        """
+
+    def log_change(action, uid, path, user=None, extra=None, when=None,
+                   portal_type=None, serial=None):
+        """
+        Log an entry about a change as for log(), given UID and path of
+        content, rather than content itself; used to log changes captured
+        earlier (at time 'when', a datetime), possibly for content no
+        longer reachable; the record is kept, queried and pruned as
+        logged at that time.  Portal type and serial (_p_serial) of content
+        before the change may be given, if known.
         """
 
     def prune(facility=None, days=None, timespec=None):
@@ -121,6 +188,29 @@ class IModificationLogger(Interface):
 
         Facility name passed may be either in noun form or in verb form as
         described in the possible action names in log().
+
+        Records are stored in monthly partitions; partitions for months
+        before that of timespec are removed whole, in constant time.
+
+        Returns a mapping of facility names to number of records removed.
+        When all facilities are pruned, with logs kept in a separate
+        database, markers of transactions (stored in the site's database)
+        for months before that of timespec are removed too, their number
+        mapped to 'transactions' (if any).
+        """
+
+    def iterprune(facility=None, days=None, timespec=None, chunk=1000):
+        """
+        Chunked equivalent of prune(), for pruning many records without
+        one large transaction: removes at most 'chunk' records at a time,
+        yielding (facility name, number removed) after each chunk;
+        whole expired partitions count as one chunk, whatever their size.
+
+        Callers are expected to commit the transaction after each chunk
+        (and may stop at any point); as pruning is by time, calling again
+        with the same timespec resumes where a previous run stopped.
+        Markers of transactions removed, if any, are yielded last, as
+        ('transactions', number removed).
         """
 
     def modified(content, user=None, extra=None):
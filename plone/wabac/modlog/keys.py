@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Record keys for modification log facilities.
+
+A record key is a negated (millisecond timestamp, segment, sequence)
+triple packed into a signed 64-bit integer, so that:
+
+- ascending BTree order is LIFO (newest first) order;
+- the segment holding a record is known from its key;
+- keys of records logged in time order by one writer are unique by
+  construction, without any lookup of keys already stored;
+- the (monthly) time partition holding a record, and the time it was
+  logged (to the millisecond), are known from its key.
+"""
+
+from datetime import datetime, timedelta
+
+import base64
+import hashlib
+import threading
+
+
+SLOT_BITS = 8
+
+SEQ_BITS = 12
+
+STAMP_SHIFT = SLOT_BITS + SEQ_BITS
+
+SEQ_MASK = (1 << SEQ_BITS) - 1
+
+SLOT_MASK = ((1 << SLOT_BITS) - 1) << SEQ_BITS
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def epoch_us(when):
+    """Naive local datetime to integer microseconds since (naive) epoch"""
+    delta = when - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_epoch_us(stamp):
+    return EPOCH + timedelta(microseconds=stamp)
+
+
+def epoch_ms(when):
+    """Naive local datetime to integer milliseconds since (naive) epoch"""
+    return epoch_us(when) // 1000
+
+
+def stamp_keys(stamp):
+    """(min, max) keys of records keyed at millisecond timestamp stamp"""
+    return (
+        -((stamp << STAMP_SHIFT) | ((1 << STAMP_SHIFT) - 1)),
+        -(stamp << STAMP_SHIFT),
+        )
+
+
+def time_bounds(since=None, until=None):
+    """
+    (first, last) keys, inclusive, bounding keys of records logged at
+    or after datetime since and before until (either may be None, for
+    no bound).  Records logged in the millisecond of since or until
+    itself need their times compared.
+    """
+    first = last = None
+    if until is not None:
+        first = stamp_keys(epoch_ms(until))[0]
+    if since is not None:
+        last = stamp_keys(epoch_ms(since))[1]
+    return first, last
+
+
+def month_partition(when):
+    """
+    Partition number for month of datetime when: negated months since
+    year zero, so that ascending order is newest first.
+    """
+    return -(when.year * 12 + when.month - 1)
+
+
+def partition_of(key):
+    """Partition number for month of timestamp encoded in record key"""
+    return month_partition(from_epoch_us((-key >> STAMP_SHIFT) * 1000))
+
+
+def slot_of(key):
+    """Segment number encoded in a record key"""
+    return (-key & SLOT_MASK) >> SEQ_BITS
+
+
+def filters_hash(filters):
+    """Short stable digest of a filters mapping"""
+    items = sorted((filters or {}).items())
+    return hashlib.sha1(repr(items)).hexdigest()[:12]
+
+
+def encode_cursor(key, filters=None):
+    """Opaque cursor for resuming filtered enumeration after key"""
+    return base64.urlsafe_b64encode('%d:%s' % (key, filters_hash(filters)))
+
+
+def decode_cursor(cursor, filters=None):
+    """
+    Key from cursor made by encode_cursor(); raises ValueError for a
+    malformed cursor, or one made for other filters.
+    """
+    try:
+        key, digest = base64.urlsafe_b64decode(str(cursor)).split(':')
+        key = int(key)
+    except (TypeError, ValueError):
+        raise ValueError('Malformed cursor: %r' % cursor)
+    if digest != filters_hash(filters):
+        raise ValueError('Cursor does not match filters')
+    return key
+
+
+def following(value):
+    """
+    Packed key value with the sequence number after that of value, in
+    the next millisecond if the sequence of value's is exhausted.
+    """
+    if value & SEQ_MASK < SEQ_MASK:
+        return value + 1
+    return (((value >> STAMP_SHIFT) + 1) << STAMP_SHIFT) | (value & SLOT_MASK)
+
+
+class KeyClock(object):
+    """
+    Issues keys for records logged by one writer, at the millisecond
+    they were logged.  Records logged in the same millisecond are told
+    apart by sequence number, strictly increasing for records logged at
+    or after the newest issued so far, so that keys are unique (and
+    LIFO-ordered) should the clock stall; only should one writer log
+    more than SEQ_MASK records in one millisecond do keys move on to the
+    next.  Records logged earlier than that (e.g. backdated, or after
+    the clock went back) are keyed at their own time, from sequence 0:
+    a key taken is found when inserting, and the following one tried.
+    """
+
+    def __init__(self):
+        self.stamp = 0  # newest millisecond logged
+        self.last = 0  # newest value issued
+
+    def advance(self, value):
+        """Never issue values at or below value (a positive, packed key)"""
+        self.last = max(self.last, value)
+
+    def next_key(self, when, slot):
+        stamp = epoch_ms(when)
+        value = (stamp << STAMP_SHIFT) | (slot << SEQ_BITS)
+        if stamp < self.stamp:
+            return -value
+        self.stamp = stamp
+        if value <= self.last:
+            value = following((self.last & ~SLOT_MASK) | (slot << SEQ_BITS))
+        self.last = value
+        return -value
+
+    def next_after(self, key):
+        """Key to try after key (of the same slot) was found taken"""
+        value = following(-key)
+        self.advance(value)
+        return -value
+
+
+_local = threading.local()
+
+
+def key_clock():
+    """Key clock for the current (writer) thread"""
+    clock = getattr(_local, 'clock', None)
+    if clock is None:
+        clock = _local.clock = KeyClock()
+    return clock
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Load simulator for modification logging by concurrent editors.
+
+Each simulated editor is a thread with its own connection to a shared
+local database, firing add, modify, move (rename) and delete events on
+stand-in content through the modification log subscribers, committing
+a few changes per transaction, and retrying on ConflictError.  Reports
+commits per second, conflicts and retries, and transaction latency.
+
+Run with the Python of a Zope instance, for example:
+
+    bin/zopepy src/plone.wabac/plone/wabac/modlog/loadtest.py \\
+        --threads 16 --transactions 200 --storage file
+"""
+
+import argparse
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from Products.CMFCore.interfaces import IContentish
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
+from zope.component import getGlobalSiteManager, provideHandler
+from zope.component.event import objectEventNotify
+from zope.component.interfaces import IObjectEvent
+from zope.component.hooks import setSite
+from zope.event import notify
+from zope.lifecycleevent import ObjectAddedEvent, ObjectModifiedEvent
+from zope.lifecycleevent import ObjectMovedEvent, ObjectRemovedEvent
+from zope.lifecycleevent import interfaces as events
+
+from plone.wabac.modlog import ModificationLogger
+from plone.wabac.modlog import handlers
+from plone.wabac.modlog.testing import StandInContent, provide_adapters
+from plone.wabac.modlog.testing import stand_in_database
+
+
+# Relative frequency of actions fired by editors:
+ACTIONS = (
+    ('add', 2),
+    ('modify', 5),
+    ('move', 1),
+    ('delete', 1),
+    )
+
+RETRIES = 10
+
+
+def provide_subscribers():
+    """
+    Register object event dispatch and modification log subscribers, as
+    in configure.zcml, unless already registered.
+    """
+    subscribers = (
+        (objectEventNotify, (IObjectEvent,)),
+        (handlers.log_modified, (IContentish, events.IObjectModifiedEvent)),
+        (handlers.log_deleted, (IContentish, events.IObjectRemovedEvent)),
+        (handlers.log_moved, (IContentish, events.IObjectMovedEvent)),
+        (handlers.log_added, (IContentish, events.IObjectAddedEvent)),
+        )
+    registry = getGlobalSiteManager().adapters
+    for handler, required in subscribers:
+        if handler not in registry.subscriptions(required, None):
+            provideHandler(handler, required)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of (sorted) values"""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Editor(object):
+    """Simulated editor, changing stand-in content of a site"""
+
+    def __init__(self, db, site_oid, name, changes=5, seed=None):
+        self.db = db
+        self.site_oid = site_oid
+        self.name = name
+        self.changes = changes
+        self.random = random.Random(seed)
+        self.actions = [a for a, weight in ACTIONS for i in range(weight)]
+        self.content = []
+        self.serial = 0
+        # results:
+        self.latencies = []
+        self.conflicts = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _new_id(self):
+        self.serial += 1
+        return '%s-%s' % (self.name, self.serial)
+
+    def plan(self):
+        """List of (action, content) changes for one transaction"""
+        planned = []
+        for i in range(self.changes):
+            action = self.random.choice(self.actions)
+            if action != 'add' and not self.content:
+                action = 'add'
+            if action == 'add':
+                content = StandInContent(self.site, self._new_id())
+                self.content.append(content)
+            else:
+                content = self.random.choice(self.content)
+            if action == 'delete':
+                self.content.remove(content)
+            planned.append((action, content))
+        return planned
+
+    def fire(self, action, content):
+        site = self.site
+        if action == 'add':
+            notify(ObjectAddedEvent(content, site, content.getId()))
+        elif action == 'modify':
+            notify(ObjectModifiedEvent(content))
+        elif action == 'move':
+            old = content.getId()
+            content.rename(self._new_id())
+            notify(ObjectMovedEvent(content, site, old, site, content.id))
+        elif action == 'delete':
+            notify(ObjectRemovedEvent(content, site, content.getId()))
+
+    def transact(self, planned):
+        began = time.time()
+        for attempt in range(RETRIES + 1):
+            transaction.begin()
+            for action, content in planned:
+                self.fire(action, content)
+            try:
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                self.conflicts += 1
+                continue
+            if attempt:
+                self.retried += 1
+            self.latencies.append(time.time() - began)
+            return
+        self.failed += 1
+
+    def __call__(self, transactions, gate=None):
+        conn = self.db.open()
+        try:
+            self.site = conn.get(self.site_oid)
+            setSite(self.site)
+            self.site.portal_membership.login(self.name)
+            if gate is not None:
+                gate.wait()
+            for i in range(transactions):
+                self.transact(self.plan())
+        finally:
+            transaction.abort()
+            setSite(None)
+            conn.close()
+
+
+def run(threads=8, transactions=100, changes=5, kind='file', seed=None):
+    """Run simulation, return mapping of results"""
+    provide_adapters()
+    provide_subscribers()
+    directory = tempfile.mkdtemp()
+    if kind == 'file':
+        storage = FileStorage(os.path.join(directory, 'Data.fs'))
+    else:
+        storage = MappingStorage()
+    db, oid = stand_in_database(storage)
+    try:
+        editors = [
+            Editor(
+                db,
+                oid,
+                'editor%s' % n,
+                changes,
+                None if seed is None else seed + n,
+                )
+            for n in range(threads)
+            ]
+        gate = threading.Event()
+        workers = [
+            threading.Thread(target=editor, args=(transactions, gate))
+            for editor in editors
+            ]
+        for worker in workers:
+            worker.start()
+        began = time.time()
+        gate.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - began
+        conn = db.open()
+        try:
+            logger = ModificationLogger(conn.get(oid))
+            records = dict(
+                (name, len(getattr(logger, name)))
+                for name in logger.ACTION_FACILITIES.values()
+                )
+        finally:
+            conn.close()
+    finally:
+        db.close()
+        shutil.rmtree(directory)
+    latencies = sorted(l for e in editors for l in e.latencies)
+    return {
+        'threads': threads,
+        'elapsed': elapsed,
+        'commits': len(latencies),
+        'commits_per_second': len(latencies) / elapsed,
+        'conflicts': sum(e.conflicts for e in editors),
+        'retried': sum(e.retried for e in editors),
+        'failed': sum(e.failed for e in editors),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'records': records,
+        }
+
+
+def report(results):
+    lines = [
+        'threads:            %(threads)s',
+        'commits:            %(commits)s in %(elapsed).2fs',
+        'commits/s:          %(commits_per_second).1f',
+        'conflict errors:    %(conflicts)s',
+        'retried commits:    %(retried)s',
+        'failed (gave up):   %(failed)s',
+        'latency p50/95/99:  %(p50_ms).1f / %(p95_ms).1f / %(p99_ms).1f ms',
+        ]
+    values = dict(results)
+    for pct in ('p50', 'p95', 'p99'):
+        values[pct + '_ms'] = results[pct] * 1000
+    text = '\n'.join(lines) % values
+    records = ', '.join(
+        '%s %s' % (count, name)
+        for name, count in sorted(results['records'].items())
+        )
+    return '%s\nrecords logged:     %s' % (text, records)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Simulate concurrent editors logging modifications.'
+        )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        nargs='+',
+        default=[8],
+        help='Numbers of concurrent editors (one run for each)',
+        )
+    parser.add_argument(
+        '--transactions',
+        type=int,
+        default=100,
+        help='Transactions per editor',
+        )
+    parser.add_argument(
+        '--changes',
+        type=int,
+        default=5,
+        help='Changes (events) per transaction',
+        )
+    parser.add_argument(
+        '--storage',
+        choices=('file', 'mapping'),
+        default='file',
+        help='Storage: temporary FileStorage (resolves conflicts, as '
+             'deployments do), or in-memory MappingStorage',
+        )
+    parser.add_argument('--seed', type=int, help='Random seed')
+    args = parser.parse_args(argv)
+    for threads in args.threads:
+        results = run(
+            threads,
+            args.transactions,
+            args.changes,
+            args.storage,
+            args.seed,
+            )
+        print(report(results))
+        print('')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
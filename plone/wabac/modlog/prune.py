@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked pruning of modification logs, committing after each chunk.
+
+May be run as a script from a Zope instance, for example:
+
+    bin/instance run src/plone.wabac/plone/wabac/modlog/prune.py \\
+        --site Plone --days 365 --chunk 1000
+
+Pruning is by time, so an interrupted run is resumed by running again.
+"""
+
+import argparse
+import itertools
+import logging
+import sys
+
+import transaction
+from zope.component.hooks import setSite
+
+from plone.wabac.modlog.interfaces import IModificationLogger
+
+
+logger = logging.getLogger('plone.wabac')
+
+
+def chunked_prune(modlog, facility=None, days=None, timespec=None,
+                  chunk=1000, chunks=None, report=None):
+    """
+    Prune modification logger modlog in chunks of at most 'chunk'
+    records, committing the transaction after each chunk; stop after
+    'chunks' chunks, if given (e.g. to bound the time taken by each
+    call from a clock server).  Optional report callable is called with
+    (facility name, removed in chunk, removed so far) after each commit.
+
+    Returns mapping of facility names to number of records removed.
+    """
+    removed = {}
+    steps = modlog.iterprune(facility, days, timespec, chunk)
+    for name, count in itertools.islice(steps, chunks):
+        transaction.commit()
+        removed[name] = removed.get(name, 0) + count
+        logger.info(
+            'Pruned %s records from %s modification log (%s so far)',
+            count,
+            name,
+            removed[name],
+            )
+        if report is not None:
+            report(name, count, removed[name])
+    return removed
+
+
+def main(app, argv):
+    parser = argparse.ArgumentParser(
+        description='Prune plone.wabac modification logs in chunks.'
+        )
+    parser.add_argument('--site', required=True, help='Path to site')
+    parser.add_argument(
+        '--days',
+        type=float,
+        required=True,
+        help='Remove records older than this many days',
+        )
+    parser.add_argument(
+        '--facility',
+        default=None,
+        help='Facility name (default: all facilities)',
+        )
+    parser.add_argument(
+        '--chunk',
+        type=int,
+        default=1000,
+        help='Records removed per transaction',
+        )
+    args = parser.parse_args(argv)
+    site = app.unrestrictedTraverse(args.site)
+    setSite(site)
+
+    def report(name, count, total):
+        print('%s: removed %s records (%s so far)' % (name, count, total))
+
+    removed = chunked_prune(
+        IModificationLogger(site),
+        args.facility,
+        args.days,
+        chunk=args.chunk,
+        report=report,
+        )
+    for name, count in sorted(removed.items()):
+        print('%s: %s records removed in total' % (name, count))
+
+
+if __name__ == '__main__':
+    main(app, sys.argv[1:])  # noqa: app is provided by "bin/instance run"
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Compact change records.
+
+Records are pickled by value inside the buckets of facility BTrees, so
+their size directly determines bucket size and load time.  Rather than
+a dict pickling a datetime and full path for every record, ChangeRecord
+pickles as a reference to its class (memoized once per bucket pickle)
+and a tuple of values:
+
+- the UID packed to 16 bytes (for usual, hex UUIDs);
+- the parent path and user id, interned so that repeated values are
+  memoized within a bucket pickle;
+- the item id;
+- an integer timestamp (microseconds since epoch), as a long, pickled
+  in binary (9 bytes) rather than as decimal text (18 bytes for an int);
+- extra metadata, if any;
+- the portal type of the content, if known;
+- a reference to the TransactionMarker of the transaction logging the
+  record, within a tuple shared by all records it logs: pickles memoize
+  the tuple (not persistent references), so it is pickled once per
+  bucket, not once per record;
+- and the serial (tid of the last committed state) of the content, if
+  it had been committed, when the change was logged.
+
+Trailing values not known are omitted.  Unpickling a record is a C-level
+tuple construction.  A bucket of 30 records of modified documents
+pickles to about 80% of the size of one of dicts of uid, path, user and
+datetime only (64% without portal type, tid and serial): record keys,
+UIDs and ids, which are not shared, dominate.
+
+The tid of the transaction logging a record is only known once it has
+committed, as the serial of its marker; together with the serial of
+the content, it locates states of content before and after the change
+in database history (e.g. for DB.open(before=tid)).
+
+Removal of a folder is logged as one record for the folder, referencing
+a separate (persistent) manifest of its removed descendants, which is
+only loaded when the record is expanded.
+"""
+
+import binascii
+import itertools
+
+from persistent import Persistent
+from ZODB.utils import z64
+
+from keys import epoch_us, from_epoch_us
+
+
+HEX = frozenset('0123456789abcdef')
+
+
+def _intern(value):
+    # intern() only accepts str (bytes), not unicode
+    return intern(value) if type(value) is str else value
+
+
+def pack_uid(uid):
+    if type(uid) is str and len(uid) == 32 and HEX.issuperset(uid):
+        return binascii.unhexlify(uid)
+    return unicode(uid)  # not packed: distinguished by type
+
+
+def unpack_uid(value):
+    if type(value) is str:
+        return binascii.hexlify(value)
+    return value
+
+
+def pack_serial(serial):
+    """Serial of persistent object, or None if never committed"""
+    if not serial or serial == z64:
+        return None
+    return serial
+
+
+class TransactionMarker(Persistent):
+    """
+    Placeholder for the tid of a transaction logging changes: stored
+    with (and referenced by) the records it logs, so its serial becomes
+    the tid once committed.  Markers are stored in the site's database
+    (see backends), also with logs kept in a separate one, so this is
+    the tid of the commit to the site's database.
+    """
+
+    @property
+    def tid(self):
+        """Tid of committing transaction, or None if not committed"""
+        self._p_activate()  # a ghost has no serial
+        return pack_serial(self._p_serial)
+
+    def reference(self):
+        """Tuple of marker, the same for all records referencing it"""
+        reference = getattr(self, '_v_reference', None)
+        if reference is None:
+            reference = self._v_reference = (self,)
+        return reference
+
+
+class ChangeRecord(tuple):
+    """
+    Immutable change record, providing read-only mapping access to
+    'uid', 'path', 'user', 'when' and (if any) 'extra' metadata,
+    'portal_type', 'tid' (of the transaction logging the record, None
+    until committed) and 'serial' (of content before the change).
+    """
+
+    __slots__ = ()
+
+    FIELDS = (
+        'uid',
+        'path',
+        'user',
+        'when',
+        'extra',
+        'portal_type',
+        'tid',
+        'serial',
+        )
+
+    # optional values, by field name, stored as tuple items from 5:
+    OPTIONAL = ('extra', 'portal_type', 'marker', 'serial')
+
+    @classmethod
+    def create(cls, uid, path, user, when, extra=None, portal_type=None,
+               marker=None, serial=None):
+        """
+        Construct record from uid, path, user, datetime, extra, portal
+        type, transaction marker and serial of content
+        """
+        parent, name = path.rsplit('/', 1) if '/' in path else ('', path)
+        values = [
+            pack_uid(uid),
+            _intern(parent),
+            name,
+            _intern(user),
+            long(epoch_us(when)),
+            dict(extra) if extra else None,
+            _intern(portal_type) if portal_type else None,
+            marker.reference() if marker is not None else None,
+            pack_serial(serial),
+            ]
+        while len(values) > 5 and values[-1] is None:
+            values.pop()  # omit trailing values not known
+        return cls(values)
+
+    def __reduce__(self):
+        return (self.__class__, (tuple(tuple.__iter__(self)),))
+
+    def _value(self, index):
+        if index < tuple.__len__(self):
+            return tuple.__getitem__(self, index)
+        return None
+
+    @property
+    def uid(self):
+        return unpack_uid(self._value(0))
+
+    @property
+    def path(self):
+        return '%s/%s' % (self._value(1), self._value(2))
+
+    @property
+    def user(self):
+        return self._value(3)
+
+    @property
+    def when(self):
+        return from_epoch_us(self._value(4))
+
+    @property
+    def extra(self):
+        return self._value(5)
+
+    @property
+    def portal_type(self):
+        return self._value(6)
+
+    @property
+    def marker(self):
+        reference = self._value(7)
+        return reference[0] if reference is not None else None
+
+    @property
+    def tid(self):
+        marker = self.marker
+        return marker.tid if marker is not None else None
+
+    @property
+    def serial(self):
+        return self._value(8)
+
+    def keys(self):
+        keys = list(self.FIELDS[:4])
+        for index, name in enumerate(self.OPTIONAL, 5):
+            if self._value(index):
+                keys.append('tid' if name == 'marker' else name)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return getattr(self, name)
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __repr__(self):
+        return '<%s %s %s by %s at %s>' % (
+            self.__class__.__name__,
+            self.uid,
+            self.path,
+            self.user,
+            self.when.isoformat(),
+            )
+
+
+class ChildManifest(Persistent):
+    """
+    UIDs and relative paths of descendants removed with a folder, kept
+    as parallel tuples in a persistent object of its own, so that the
+    record of the removal stays small.
+    """
+
+    def __init__(self, path, descendants):
+        """Given folder path and mapping of descendant uid to path"""
+        prefix = len(path) + 1
+        self.uids = tuple(pack_uid(uid) for uid in descendants.keys())
+        self.paths = tuple(p[prefix:] for p in descendants.values())
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __iter__(self):
+        """Iterate (uid, path relative to folder) pairs"""
+        return itertools.izip(
+            itertools.imap(unpack_uid, self.uids),
+            self.paths,
+            )
+
+    def records(self, record):
+        """Records of descendants, given record of folder removal"""
+        extra = {'ancestor': record.uid}
+        for uid, path in self:
+            yield ChangeRecord.create(
+                uid,
+                '%s/%s' % (record.path, path),
+                record.user,
+                record.when,
+                extra,
+                marker=record.marker,
+                )
+
+
+def expand_descendants(records):
+    """
+    Iterate records, each record of a folder removal followed by
+    records of the descendants removed with it (extra 'ancestor' is
+    the UID of the folder).
+    """
+    for record in records:
+        yield record
+        manifest = (record.extra or {}).get('descendants')
+        if manifest is not None:
+            for descendant in manifest.records(record):
+                yield descendant
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Per-writer segments of facility storage.
+
+Each facility keeps a fixed number of segments, and each writer thread
+only ever inserts into its own segment, so concurrent transactions
+logging changes never modify the same persistent objects.  Readers
+merge the (already LIFO ordered) segments at enumeration time.
+
+A writer is identified by its client process (e.g. ZEO client) and its
+thread: each client owns a range of segments, one per writer thread,
+given its number and its number of threads in zope.conf, e.g. for the
+second of two ZEO clients of four threads each:
+
+    <product-config plone.wabac>
+        modlog-client 1
+        modlog-threads 4
+    </product-config>
+
+Clients configured with distinct numbers, with SEGMENTS writer threads
+in total at most, never share a segment.  Threads of a client beyond
+its number of threads take segments of the next client.
+
+Segments also keep their own secondary indexes of record keys by uid,
+user and path, and counts of records by user, day and portal type
+(maintained as records are added and removed), for the same reason.
+The record of removal of a folder is counted once, as one record, and
+found by the uids of the descendants removed with it (from its
+manifest) through one mapping of descendant uid to record keys per
+segment, rather than an index entry (and tree set) per descendant;
+queries by path find it by the path of the folder, one of those of
+the ancestors of the path queried, in a mapping of folder paths to
+record keys.
+Counts are conflict-resolving (a Length per counted value), so that
+writers sharing a segment (e.g. clients not given distinct numbers) do
+not conflict on counts of the same day.
+"""
+
+import heapq
+import itertools
+import threading
+
+import BTrees
+from BTrees.Length import Length
+from persistent import Persistent
+
+from config import product_config
+from keys import stamp_keys
+
+
+# Number of segments per facility; must fit in keys.SLOT_BITS:
+SEGMENTS = 16
+
+# Default number of writer threads per client (as Zope's zserver-threads):
+THREADS = 4
+
+# Record fields with secondary indexes of record keys:
+INDEXES = ('uid', 'user', 'path')
+
+# Combinations of fields counted ('day' is the date logged, ISO 8601):
+AGGREGATES = (
+    ('user',),
+    ('day',),
+    ('portal_type',),
+    ('user', 'day'),
+    ('portal_type', 'day'),
+    )
+
+
+def aggregate_values(record):
+    return {
+        'user': record.get('user'),
+        'day': record.get('when').date().isoformat(),
+        'portal_type': record.get('portal_type'),
+        }
+
+
+def descendant_uids(record):
+    """UIDs of descendants removed with folder, given record of removal"""
+    manifest = (record.get('extra') or {}).get('descendants')
+    if manifest is None:
+        return ()
+    return [uid for uid, path in manifest]
+
+
+def ancestor_paths(path):
+    """Paths of which path (a path, or prefix of paths) is within"""
+    parts = path.split('/')
+    for end in range(2, len(parts)):
+        yield '/'.join(parts[:end])
+
+
+_local = threading.local()
+
+# Threads of this process are numbered in order of their first write:
+_threads = itertools.count()
+
+
+def client_slot(client, thread, threads=THREADS):
+    """Segment number of writer thread number 'thread' of client 'client'"""
+    return (client * threads + thread) % SEGMENTS
+
+
+def assign_writer(client, thread):
+    """
+    Identify the current thread as writer thread number 'thread' of
+    client 'client' (e.g. to simulate several clients in one process).
+    """
+    threads = int(product_config('modlog-threads', THREADS))
+    _local.slot = client_slot(client, thread, threads)
+
+
+def writer_slot():
+    """
+    Segment number for the current thread, stable for its lifetime: that
+    of the next writer thread of this client, as configured.
+    """
+    slot = getattr(_local, 'slot', None)
+    if slot is None:
+        client = int(product_config('modlog-client', 0))
+        assign_writer(client, next(_threads))
+        slot = _local.slot
+    return slot
+
+
+def merge(*iterables):
+    """Merge LIFO-ordered iterables of keys or (key, value) pairs"""
+    return heapq.merge(*iterables)
+
+
+class LogSegment(Persistent):
+    """Records of a facility written by one writer slot"""
+
+    family = BTrees.family64
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.records = self.family.IO.BTree()
+        self.count = Length()
+        self.indexes = dict(
+            (name, self.family.OO.BTree()) for name in INDEXES
+            )
+        self.aggregates = dict(
+            (fields, self.family.OO.BTree()) for fields in AGGREGATES
+            )
+        # of records of removal of folders, by descendant uid, path:
+        self.descendants = self.family.OO.BTree()
+        self.folders = self.family.OO.BTree()
+
+    def aggregate(self, record, delta):
+        """Add delta to counts of records for values of record"""
+        values = aggregate_values(record)
+        for fields, counts in self.aggregates.items():
+            value = tuple(values[name] for name in fields)
+            if None in value:
+                continue
+            count = counts.get(value)
+            if count is None:
+                count = counts[value] = Length()
+            # counts reaching zero are kept (skipped when read): removing
+            # them would lose concurrent changes
+            count.change(delta)
+
+    def counted(self, fields, prefix=()):
+        """
+        Iterate (values, count) pairs of counts for fields, only for
+        values starting with prefix (a tuple), if given.
+        """
+        counts = self.aggregates[fields]
+        items = counts.iteritems()
+        if prefix:
+            items = itertools.takewhile(
+                lambda item: item[0][:len(prefix)] == prefix,
+                counts.iteritems(min=prefix),
+                )
+        counted = ((value, count()) for value, count in items)
+        return ((value, count) for value, count in counted if count > 0)
+
+    def index(self, key, record):
+        self.aggregate(record, 1)
+        for name, index in self.indexes.items():
+            value = record.get(name)
+            if value is None:
+                continue
+            keys = index.get(value)
+            if keys is None:
+                keys = index[value] = self.family.IO.TreeSet()
+            keys.insert(key)
+        uids = descendant_uids(record)
+        if uids:
+            self.removal(self.folders, record.get('path'), key)
+            for uid in uids:
+                self.removal(self.descendants, uid, key)
+
+    def removal(self, mapping, value, key):
+        """Map value to key of record of removal of a folder"""
+        # (keys of records pruned since are dropped as found)
+        records = self.records
+        keys = tuple(k for k in mapping.get(value, ()) if k in records)
+        mapping[value] = (key,) + keys
+
+    def unindex(self, key, record):
+        # (removals of folders are not unindexed, not to load manifests:
+        # keys of records removed are skipped when found, and dropped
+        # along with their partition)
+        self.aggregate(record, -1)
+        for name, index in self.indexes.items():
+            value = record.get(name)
+            keys = index.get(value) if value is not None else None
+            if keys is None or key not in keys:
+                continue
+            keys.remove(key)
+            if not keys:
+                del(index[value])
+
+    def removals(self, mapping, values):
+        """Keys of records of removal of folders, mapped from values"""
+        records = self.records
+        keys = [
+            k for value in values for k in mapping.get(value, ())
+            if k in records
+            ]
+        return self.family.IO.TreeSet(keys) if keys else None
+
+    def prefixed(self, name, prefix):
+        """
+        Union of keys for all values of index starting with prefix,
+        by range scan over the (sorted) index.
+        """
+        sets = []
+        for value, keys in self.indexes[name].items(min=prefix):
+            if not value.startswith(prefix):
+                break
+            sets.append(keys)
+        return self.family.IO.multiunion(sets) if sets else None
+
+    def search(self, query):
+        """
+        Given query mapping of index names to values, return (LIFO)
+        ordered set of keys of records matching all values; values
+        are matched exactly, except for path, matched as a prefix.
+        Keys of records of removal of folders with descendants that may
+        match uid or path are included, for the caller to match.
+        """
+        result = None
+        for name, value in query.items():
+            if name == 'path':
+                keys = (
+                    self.prefixed(name, value),
+                    self.removals(self.folders, ancestor_paths(value)),
+                    )
+            elif name == 'uid':
+                keys = (
+                    self.indexes[name].get(value),
+                    self.removals(self.descendants, (value,)),
+                    )
+            else:
+                keys = (self.indexes[name].get(value),)
+            keys = filter(None, keys)
+            if not keys:
+                return ()
+            if len(keys) > 1:
+                keys = [self.family.IO.multiunion(keys)]
+            keys = keys[0]
+            if result is None:
+                result = keys
+            else:
+                result = self.family.IO.intersection(result, keys)
+        return result if result is not None else ()
+
+    def prune(self, timespec, stamp, limit=None):
+        """
+        Remove (at most limit) records logged before datetime timespec,
+        at epoch millisecond stamp, return number of records removed.
+        Keys are time-ordered, so expired records are found by a range
+        scan; only the millisecond of timespec itself needs records
+        compared.
+        """
+        records = self.records
+        first, last = stamp_keys(stamp)
+        expired = itertools.chain(
+            records.items(min=last, excludemin=True),
+            (
+                (k, r) for k, r in records.items(min=first, max=last)
+                if r.get('when') < timespec
+                )
+            )
+        expired = list(itertools.islice(expired, limit))
+        for key, record in expired:
+            self.unindex(key, record)
+            del(records[key])
+        if expired:
+            self.count.change(-len(expired))
+        return len(expired)
+
+    def select(self, query=None, after=None, first=None, last=None):
+        """
+        Iterate (key, record) pairs in LIFO order for records matching
+        query (as for search), or for all records without query; if key
+        'after' is given, start after it, in O(log n).  Keys first and
+        last, if given, bound the range scanned (inclusive).
+        """
+        bounds = {}
+        if after is not None and (first is None or after >= first):
+            bounds = {'min': after, 'excludemin': True}
+        elif first is not None:
+            bounds = {'min': first}
+        if last is not None:
+            bounds['max'] = last
+        if not query:
+            return iter(self.records.items(**bounds))
+        keys = self.search(query)
+        if not keys:
+            return iter(())
+        records = self.records
+        return ((k, records[k]) for k in keys.keys(**bounds))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in site and content objects for exercising modification logging
+against a standalone ZODB database (e.g. from concurrency tests), where
+a full Plone site would be too heavy.
+
+Outside of a configured Zope/Plone environment (e.g. for benchmarks or
+load tests), call provide_adapters() first.
+"""
+
+import threading
+import transaction
+import uuid
+
+from persistent import Persistent
+from plone.uuid.adapter import attributeUUID
+from plone.uuid.interfaces import ATTRIBUTE_NAME, IAttributeUUID
+from Products.CMFCore.interfaces import IContentish, ISiteRoot
+from ZODB import DB
+from ZODB.MappingStorage import MappingStorage
+from zope.annotation.attribute import AttributeAnnotations
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.component import getGlobalSiteManager, provideAdapter
+from zope.interface import implements
+
+
+class StandInMember(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def getUserName(self):
+        return self.name
+
+
+class StandInMembership(object):
+    """Membership tool, authenticating a user per thread"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def login(self, name):
+        self._local.name = name
+
+    def getAuthenticatedMember(self):
+        return StandInMember(getattr(self._local, 'name', 'admin'))
+
+
+class StandInSite(Persistent):
+    """Annotatable, persistent site root"""
+
+    implements(ISiteRoot, IAttributeAnnotatable)
+
+    portal_membership = StandInMembership()
+
+    def __init__(self, id='plone'):
+        self.id = id
+
+    def getId(self):
+        return self.id
+
+    def getPhysicalPath(self):
+        return ('', self.id)
+
+    def getSiteManager(self):
+        return getGlobalSiteManager()
+
+
+class StandInContent(object):
+    """Content item with UUID, located in a stand-in site"""
+
+    implements(IContentish, IAttributeUUID)
+
+    def __init__(self, site, id):
+        self.id = id
+        self._path = site.getPhysicalPath() + (id,)
+        setattr(self, ATTRIBUTE_NAME, uuid.uuid4().hex)
+
+    def getId(self):
+        return self.id
+
+    def getPhysicalPath(self):
+        return self._path
+
+    def rename(self, id):
+        self.id = id
+        self._path = self._path[:-1] + (id,)
+
+
+def provide_adapters():
+    """Register annotation and UUID adapters needed by stand-ins"""
+    provideAdapter(AttributeAnnotations)
+    provideAdapter(attributeUUID)
+
+
+def stand_in_database(storage=None, name='site', log_database=None):
+    """
+    Open database on storage (default: in-memory MappingStorage) with a
+    StandInSite in its root under 'name', return (db, site oid).
+
+    If log_database is given, also open an in-memory database of that
+    name, in the same multi-database, as stand-in for a mounted database
+    for modification log storage.
+    """
+    databases = {}
+    db = DB(
+        storage if storage is not None else MappingStorage(),
+        databases=databases,
+        )
+    if log_database is not None:
+        DB(MappingStorage(), databases=databases, database_name=log_database)
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    site = conn.root()[name] = StandInSite()
+    tm.commit()
+    oid = site._p_oid
+    conn.close()
+    return db, oid
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Restoration of deleted or modified content from database history.
+
+States of content to restore are read through historical (read-only)
+connections to the database of the site, as of before the transaction
+that deleted or modified the content (see history).
+"""
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Batch restoration of deleted and modified content.
+
+Given records of deletions and modifications (e.g. selected from the
+modification log), a batch restore plans all its work up-front:
+
+- the parent of each deleted item is looked up once per distinct path;
+  ancestors missing from the live site (and not restored themselves)
+  are recreated once, as shallow copies (empty containers), however
+  many restored items they contain; items whose nearest live ancestor
+  is not a folder (e.g. an item created at the path of a removed
+  folder since) are not restored, as their path is in use;
+- items removed along with a folder restored from the same transaction
+  are restored with (as contents of) the folder, not again;
+- work is ordered parent-first, and otherwise grouped by source tid,
+  so that items read from the same historical state share one pooled,
+  warm historical connection (see history).
+
+Planned work may be previewed (a dry run, writing nothing), or applied
+in transactions of bounded size, committing after
+each, and reporting progress.  Deleted items are restored as copies of
+their historical state, with their original UUIDs: folders streamed
+item by item, with their contents (see stream), other items whole.
+Modified items have values of their fields restored in place.
+"""
+
+from collections import OrderedDict
+
+import logging
+
+from plone.uuid.interfaces import ATTRIBUTE_NAME, IUUID
+from Products.CMFCore.utils import getToolByName
+from transaction.interfaces import InvalidSavepointRollbackError
+from ZODB.POSException import ConflictError
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+import transaction
+
+from plone.wabac.restore.content import copy_fields, field_diffs, full_copy
+from plone.wabac.restore.content import historical_object, live_object
+from plone.wabac.restore.content import shallow_copy
+from plone.wabac.restore.history import HistoricalConnections, before_tid
+from plone.wabac.restore.stream import SubtreeRestore, folderish
+from plone.wabac.utils import parentPath, sitePath
+
+
+logger = logging.getLogger('plone.wabac')
+
+# Reasons for records not to be restored:
+NO_TRANSACTION = 'no transaction recorded'
+
+PATH_IN_USE = 'path in use'
+
+UID_IN_USE = 'UID in use'
+
+WITH_ANCESTOR = 'with ancestor'
+
+
+class RestoreTask(object):
+    """
+    Restoration of content at path as of before tid: 'delete' (full
+    copy), 'ancestor' (shallow copy), or 'modify' (field values)
+    """
+
+    def __init__(self, kind, path, before, uid=None):
+        self.kind = kind
+        self.path = path  # in history
+        self.live_path = path  # differs for modified items moved since
+        self.before = before
+        self.uid = uid
+        self.level = 0  # number of ancestors restored first
+
+    def sort_key(self):
+        return (self.level, self.before, self.path)
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.kind, self.path)
+
+
+class BatchRestore(object):
+    """
+    Restore of content from records of deletions and modifications in
+    site, committing after every 'size' tasks; optional report callable
+    is called with (tasks done, tasks in total) after each commit.
+    """
+
+    def __init__(self, site, deleted=(), modified=(), size=100,
+                 report=None, connections=None):
+        self.site = site
+        self.deleted = list(deleted)
+        self.modified = list(modified)
+        self.size = size
+        self.report = report
+        self.connections = connections
+        self.site_path = '/'.join(sitePath(site))
+        self._live = {}  # path -> content exists in live site
+        self._folders = {}  # path -> live content there is folderish
+        self.skipped = []  # (path, reason) of records not restored
+
+    def exists(self, path):
+        """Content at path exists in live site (looked up once)"""
+        if path not in self._live:
+            self._live[path] = live_object(self.site, path) is not None
+        return self._live[path]
+
+    def contained(self, path):
+        """
+        Nearest ancestor of path in live site is a folder (or the site
+        itself), to restore content at path in (looked up once)
+        """
+        for parent in self.ancestors(path):
+            if self.exists(parent):
+                if parent not in self._folders:
+                    self._folders[parent] = folderish(
+                        live_object(self.site, parent))
+                return self._folders[parent]
+        return True
+
+    def uid_in_use(self, uid):
+        catalog = getToolByName(self.site, 'portal_catalog')
+        return bool(catalog.unrestrictedSearchResults(UID=uid))
+
+    def resumable(self, task):
+        """Folder deleted is at its path, as restored by an earlier run"""
+        content = live_object(self.site, task.path)
+        return folderish(content) and IUUID(content, None) == task.uid
+
+    def ancestors(self, path):
+        """Ancestor paths of path within site, nearest first"""
+        parent = parentPath(path)
+        while len(parent) > len(self.site_path):
+            yield parent
+            parent = parentPath(parent)
+
+    def _records(self):
+        """
+        (kind, record) pairs of the record to restore each UID from: the
+        newest logged for it, deleted or modified, but that of its
+        deletion if deleted and not live (any more).
+        """
+        found = OrderedDict()  # uid -> kind -> newest record
+        for kind, records in (
+                ('modify', self.modified), ('delete', self.deleted)):
+            for record in records:
+                newest = found.setdefault(record.get('uid'), {})
+                if kind not in newest or (
+                        record.get('when') > newest[kind].get('when')):
+                    newest[kind] = record
+        for uid, newest in found.items():
+            if len(newest) == 1:
+                kind = newest.keys()[0]
+            elif self.uid_in_use(uid):
+                kind = max(newest, key=lambda k: newest[k].get('when'))
+            else:
+                kind = 'delete'
+            yield kind, newest[kind]
+
+    def _tasks(self):
+        for kind, record in self._records():
+            uid, path = record.get('uid'), record.get('path')
+            before = before_tid(record, self.site._p_jar.db())
+            if before is None:
+                self.skipped.append((path, NO_TRANSACTION))
+                continue
+            yield RestoreTask(kind, path, before, uid)
+
+    def plan(self):
+        """Tasks, parent-first, and otherwise grouped by source tid"""
+        tasks = {}  # live path -> task
+        self.skipped = []
+        catalog = getToolByName(self.site, 'portal_catalog')
+        planned = list(self._tasks())
+        for task in [t for t in planned if t.kind == 'modify']:
+            brains = catalog.unrestrictedSearchResults(UID=task.uid)
+            if brains:
+                task.live_path = brains[0].getPath()
+            else:
+                task.kind = 'delete'  # no longer exists: restore whole
+            tasks.setdefault(task.live_path, task)
+        for task in [t for t in planned if t.kind == 'delete']:
+            if task.path in tasks:
+                self.skipped.append((task.path, PATH_IN_USE))
+            elif self.exists(task.path):
+                if not self.resumable(task):
+                    self.skipped.append((task.path, PATH_IN_USE))
+                    continue
+                tasks[task.path] = task  # folder partially restored
+            elif self.uid_in_use(task.uid):
+                self.skipped.append((task.path, UID_IN_USE))
+            else:
+                tasks[task.path] = task
+        for task in [t for t in tasks.values() if t.kind == 'delete']:
+            if not self.contained(task.path):
+                # path of an ancestor is in use by an item, not a folder
+                del(tasks[task.path])
+                self.skipped.append((task.path, PATH_IN_USE))
+        deletions = sorted(
+            (t for t in tasks.values() if t.kind == 'delete'),
+            key=lambda t: len(t.path),
+            )
+        for task in deletions:
+            # removed with a folder restored from the same transaction:
+            # restored as its contents
+            for path in self.ancestors(task.path):
+                ancestor = tasks.get(path)
+                if ancestor is not None and ancestor.kind == 'delete' and (
+                        ancestor.before == task.before):
+                    del(tasks[task.path])
+                    self.skipped.append((task.path, WITH_ANCESTOR))
+                    break
+        for task in [t for t in tasks.values() if t.kind == 'delete']:
+            for path in self.ancestors(task.path):
+                if path in tasks or self.exists(path):
+                    break
+                # missing, recreated once for all items it contains:
+                tasks[path] = RestoreTask('ancestor', path, task.before)
+        for path, task in tasks.items():
+            task.level = sum(1 for p in self.ancestors(path) if p in tasks)
+        return sorted(tasks.values(), key=RestoreTask.sort_key)
+
+    def preview(self):
+        """
+        Dry run, reading records, the catalog, live and historical content
+        only: return mapping of 'restore' (planned (kind, path) pairs, in
+        order), 'ancestors' (paths of missing ancestors to recreate),
+        'conflicts' (paths in use), 'uids_in_use' (paths of items whose
+        UID is), 'not_found' (paths not found in history), 'diffs' (live
+        path of each modified item to mapping of differing field names to
+        (historical, live) values) and 'skipped' ((path, reason) pairs).
+        """
+        tasks = self.plan()
+        connections = self.connections
+        if connections is None:
+            connections = HistoricalConnections(self.site._p_jar.db())
+        not_found, diffs = [], {}
+        try:
+            for task in tasks:
+                conn = connections.get(task.before)
+                source = historical_object(self.site, conn, task.path)
+                if source is None:
+                    not_found.append(task.path)
+                elif task.kind == 'modify':
+                    content = live_object(self.site, task.live_path)
+                    diffs[task.live_path] = field_diffs(source, content)
+        finally:
+            if self.connections is None:
+                connections.close()
+        return {
+            'restore': [(task.kind, task.path) for task in tasks],
+            'ancestors': [t.path for t in tasks if t.kind == 'ancestor'],
+            'conflicts': [p for p, r in self.skipped if r == PATH_IN_USE],
+            'uids_in_use': [p for p, r in self.skipped if r == UID_IN_USE],
+            'not_found': not_found,
+            'diffs': diffs,
+            'skipped': self.skipped,
+            }
+
+    def _restore(self, connections, task):
+        conn = connections.get(task.before)
+        source = historical_object(self.site, conn, task.path)
+        if source is None:
+            raise ValueError('Not found in history: %s' % task.path)
+        if task.kind == 'modify':
+            content = live_object(self.site, task.live_path)
+            copy_fields(source, content, content._p_jar)
+            content.reindexObject()
+            notify(ObjectModifiedEvent(content))
+            return
+        container = live_object(self.site, parentPath(task.path))
+        if container is None:
+            raise ValueError('Container not found: %s' % task.path)
+        if task.kind == 'delete' and folderish(source):
+            SubtreeRestore(source, container, self.size).run()
+            return
+        if task.kind == 'ancestor':
+            content = shallow_copy(source, container)
+            if self.uid_in_use(IUUID(content)):
+                # (e.g. moved since): a new UUID is assigned when added
+                delattr(content, ATTRIBUTE_NAME)
+        else:
+            content = full_copy(source, container)
+        container._setObject(content.getId(), content, set_owner=0)
+
+    def apply(self, connections, task):
+        """Apply task, return error message, or None if successful"""
+        savepoint = transaction.savepoint()
+        try:
+            self._restore(connections, task)
+        except ConflictError:
+            raise
+        except Exception as e:
+            try:
+                savepoint.rollback()
+            except InvalidSavepointRollbackError:
+                # committed since, by checkpoint of streamed subtree,
+                # which is resumed by restoring it again
+                transaction.abort()
+            logger.warning('Could not restore %s: %s', task.path, e)
+            return str(e) or e.__class__.__name__
+        return None
+
+    def run(self):
+        """
+        Plan and apply restoration, return mapping of 'restored' (paths),
+        'failed' and 'skipped' ((path, reason) pairs).
+        """
+        tasks = self.plan()
+        connections = self.connections
+        if connections is None:
+            connections = HistoricalConnections(self.site._p_jar.db())
+        restored, failed = [], []
+        try:
+            for done, task in enumerate(tasks, 1):
+                error = self.apply(connections, task)
+                if error is None:
+                    restored.append(task.path)
+                else:
+                    failed.append((task.path, error))
+                if done % self.size and done != len(tasks):
+                    continue
+                transaction.commit()
+                logger.info('Restored %s of %s items', done, len(tasks))
+                if self.report is not None:
+                    self.report(done, len(tasks))
+        finally:
+            if self.connections is None:
+                connections.close()
+        return {
+            'restored': restored,
+            'failed': failed,
+            'skipped': self.skipped,
+            }
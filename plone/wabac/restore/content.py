@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Finding and copying content, live or historical, by path.
+
+Historical objects are read unwrapped (without acquisition) from a
+historical connection, and copied into the live site:
+
+- whole, with contained items, by export from the historical connection
+  and import into the live one (OFS _getCopy);
+- or shallow, as a new, empty Dexterity item of the same type, with
+  the item's own state copied (id, UUID, field values, workflow history,
+  local roles, owner, layout, dates, annotations such as portlet
+  assignments...), but not its contents, e.g. to recreate a removed
+  folder as container for restored items only.
+
+Field values are copied by value; files and images (with their blobs)
+by export and import.  Values referring to other content or blobs
+(e.g. relations) are not copied.
+"""
+
+from cStringIO import StringIO
+
+import copy
+import cPickle
+import tempfile
+
+from Acquisition import aq_base
+from BTrees.OOBTree import OOBTree
+from persistent import Persistent
+from plone.dexterity.interfaces import IDexterityContent
+from plone.dexterity.utils import createContent, iterSchemataForType
+from plone.namedfile.interfaces import INamed
+from Products.CMFCore.interfaces import IContentish
+from ZODB.blob import Blob
+from zope.schema import getFieldNames
+
+from plone.wabac.utils import traversable
+
+
+_marker = object()
+
+# Attributes of folders keeping their contents, not copied by
+# shallow_copy:
+CONTENTS = ('_tree', '_count', '_mt_index', '_objects')
+
+# Annotations of folders keeping the order of their contents, not copied
+# either (contents restored are ordered as added):
+ORDERING = ('plone.folder.ordered.order', 'plone.folder.ordered.pos')
+
+
+def live_object(site, path):
+    """
+    Live content at absolute path, or None: looked up by id in each
+    container, not traversed, as traversal may acquire an object of the
+    same id from elsewhere (and items only, not other attributes).
+    """
+    ob = site
+    for name in filter(None, traversable(path, site).split('/')):
+        if getattr(aq_base(ob), '_getOb', None) is None:
+            return None
+        ob = ob._getOb(name, None)
+        if getattr(aq_base(ob), 'getId', None) is None or (
+                ob.getId() != name):
+            return None
+    return ob
+
+
+def historical_object(site, conn, path):
+    """
+    Content at absolute path in site, as read by historical connection
+    conn, or None if not found there.
+    """
+    ob = conn.get(site._p_oid)
+    for name in filter(None, traversable(path, site).split('/')):
+        get = getattr(aq_base(ob), '_getOb', None)
+        ob = get(name, None) if get is not None else None
+        if ob is None:
+            return None
+    return ob
+
+
+def persistent_copy(ob, jar):
+    """Copy of persistent ob (and objects it references) added to jar"""
+    f = tempfile.TemporaryFile()
+    try:
+        ob._p_jar.exportFile(ob._p_oid, f)
+        f.seek(0)
+        return jar.importFile(f)
+    finally:
+        f.close()
+
+
+def refers_persistent(value):
+    """Value is or refers to persistent objects"""
+    found = []
+
+    def persistent_id(ob):
+        if isinstance(ob, Persistent):
+            found.append(ob)
+            return 'found'
+        return None
+
+    pickler = cPickle.Pickler(StringIO(), 1)
+    pickler.persistent_id = persistent_id
+    pickler.dump(value)
+    return bool(found)
+
+
+def state_copy(value, source, target):
+    """
+    Copy of value in state of historical content source, for target:
+    persistent objects it refers to are copied by value, references to
+    source refer to target.  Values referring to other content or to
+    blobs are not copied: _marker is returned.
+    """
+    refused = []
+
+    def persistent_id(ob):
+        if ob is source:
+            return 'source'
+        if isinstance(ob, Blob) or IContentish.providedBy(ob):
+            refused.append(ob)
+            return 'refused'
+        return None
+
+    f = StringIO()
+    pickler = cPickle.Pickler(f, 1)
+    pickler.persistent_id = persistent_id
+    pickler.dump(value)
+    if refused:
+        return _marker
+    unpickler = cPickle.Unpickler(StringIO(f.getvalue()))
+    unpickler.persistent_load = lambda oid: target
+    return unpickler.load()
+
+
+def copy_fields(source, target, jar):
+    """
+    Copy values of schema fields of Dexterity content source to target,
+    files and images by export to jar.
+    """
+    if not IDexterityContent.providedBy(source):
+        raise ValueError('Not Dexterity content: %s' % source.getId())
+    source = aq_base(source)
+    for schema in iterSchemataForType(source.portal_type):
+        for name in getFieldNames(schema):
+            value = getattr(source, name, _marker)
+            if value is _marker:
+                continue
+            if INamed.providedBy(value):
+                value = persistent_copy(value, jar)
+            elif refers_persistent(value):
+                continue
+            else:
+                value = copy.deepcopy(value)
+            setattr(target, name, value)
+
+
+def _comparable(value):
+    if INamed.providedBy(value):
+        return (value.filename, value.getSize())
+    return value
+
+
+def field_diffs(source, target):
+    """
+    Mapping of names of schema fields of Dexterity content source with
+    values differing from those of target, to (source value, target
+    value); files and images are compared by name and size, values
+    referring to other persistent objects are not compared.
+    """
+    if not IDexterityContent.providedBy(source):
+        raise ValueError('Not Dexterity content: %s' % source.getId())
+    source, target = aq_base(source), aq_base(target)
+    diffs = {}
+    for schema in iterSchemataForType(source.portal_type):
+        for name in getFieldNames(schema):
+            values = [
+                _comparable(getattr(ob, name, None))
+                for ob in (source, target)
+                ]
+            if any(refers_persistent(value) for value in values):
+                continue
+            if values[0] != values[1]:
+                diffs[name] = tuple(values)
+    return diffs
+
+
+def full_copy(source, container):
+    """Copy of historical source, with its contents, for container"""
+    return aq_base(source)._getCopy(container)
+
+
+def shallow_copy(source, container):
+    """
+    New, empty item of the type of historical source, with its own state
+    (but not its contents), for container
+    """
+    if not IDexterityContent.providedBy(source):
+        raise ValueError('Not Dexterity content: %s' % source.getId())
+    ob = createContent(source.portal_type)
+    source = aq_base(source)
+    source._p_activate()  # a ghost has no state
+    for name, value in source.__dict__.items():
+        if name in CONTENTS:
+            continue
+        if name == '__annotations__':
+            annotations = ob.__annotations__ = OOBTree()
+            for key, item in value.items():
+                if key in ORDERING:
+                    continue
+                item = state_copy(item, source, ob)
+                if item is not _marker:
+                    annotations[key] = item
+            continue
+        value = state_copy(value, source, ob)
+        if value is not _marker:
+            ob.__dict__[name] = value
+    copy_fields(source, ob, container._p_jar)
+    return ob
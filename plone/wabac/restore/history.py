@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Pooled historical connections, for reading states of content as of
+before a transaction (as zc.beforestorage provides for a whole database,
+but per connection, via DB.open(before=tid)).
+
+Restoring many items changed by the same transaction (e.g. a removal of
+hundreds of items) reads them all through one historical connection,
+keeping its object cache warm, rather than opening a connection (with a
+cold cache) per item.  Connections are kept open while in use, evicted
+least recently used first, beyond a number of connections or an
+estimated total cache size, configurable in zope.conf:
+
+    <product-config plone.wabac>
+        restore-connections 4
+        restore-cache-mb 256
+    </product-config>
+"""
+
+from collections import OrderedDict
+
+import transaction
+from ZODB.utils import p64, u64
+
+from plone.wabac.modlog.config import product_config
+
+
+# Default number of historical connections kept open:
+CONNECTIONS = 4
+
+# Default cap of estimated size of objects cached, in total, by them:
+CACHE_MB = 256
+
+
+def before_tid(record, db=None):
+    """
+    Tid of database states to read to restore content of change record
+    as of before the change: the tid of the transaction logging it, or,
+    failing that (e.g. not committed), the tid after content's serial;
+    None if neither is known.
+
+    Given the (site's) database db, the tid of a marker stored in
+    another database (e.g. by earlier versions, with logs kept in a
+    separate database) is not used: it is not a tid of db.
+    """
+    tid = record.get('tid')
+    if tid is not None and (db is None or _marker_db(record) is db):
+        return tid
+    serial = record.get('serial')
+    if serial is not None:
+        return p64(u64(serial) + 1)
+    return None
+
+
+def _marker_db(record):
+    jar = getattr(getattr(record, 'marker', None), '_p_jar', None)
+    return jar.db() if jar is not None else None
+
+
+class HistoricalConnections(object):
+    """
+    Pool of read-only historical connections to database db, keyed by
+    (before) tid, least recently used first.
+    """
+
+    def __init__(self, db, connections=None, cache_mb=None):
+        self.db = db
+        self.limit = int(
+            connections or product_config('restore-connections', CONNECTIONS)
+            )
+        cache_mb = cache_mb or product_config('restore-cache-mb', CACHE_MB)
+        self.cache_bytes = int(float(cache_mb) * 1024 * 1024)
+        # connections join transactions of their own manager, not those
+        # of (e.g. restoring) connections to the current database:
+        self.transaction_manager = transaction.TransactionManager()
+        self.connections = OrderedDict()
+        self.hits = self.misses = self.evicted = 0
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __contains__(self, before):
+        return before in self.connections
+
+    def get(self, before):
+        """Historical connection reading states before tid 'before'"""
+        conn = self.connections.pop(before, None)
+        if conn is None:
+            self.misses += 1
+            conn = self.db.open(
+                transaction_manager=self.transaction_manager,
+                before=before,
+                )
+        else:
+            self.hits += 1
+        self.connections[before] = conn  # most recently used
+        self.trim()
+        return conn
+
+    def get_object(self, before, oid):
+        """State of persistent object oid before tid 'before'"""
+        return self.get(before).get(oid)
+
+    def estimated_size(self):
+        """Estimated size (bytes) of objects cached by all connections"""
+        return sum(
+            conn._cache.total_estimated_size
+            for conn in self.connections.values()
+            )
+
+    def trim(self):
+        """
+        Evict least recently used connections beyond the number or cache
+        size allowed; should the most recently used connection alone
+        exceed the cache size, minimize its cache.
+        """
+        while len(self.connections) > self.limit:
+            self._evict()
+        while (len(self.connections) > 1 and
+               self.estimated_size() > self.cache_bytes):
+            self._evict()
+        if self.estimated_size() > self.cache_bytes:
+            for conn in self.connections.values():
+                conn.cacheMinimize()
+
+    def _evict(self):
+        before, conn = self.connections.popitem(last=False)
+        conn.close()
+        self.evicted += 1
+
+    def close(self):
+        """Close all connections"""
+        self.transaction_manager.abort()
+        connections, self.connections = self.connections, OrderedDict()
+        for conn in connections.values():
+            conn.close()
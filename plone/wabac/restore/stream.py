@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming restoration of (large) historical subtrees.
+
+Copying a folder whole (OFS _getCopy) exports and imports all of its
+contents at once, in one transaction.  Instead, a subtree is walked
+depth-first in its historical state, restoring one item at a time:
+folders as shallow copies (to be filled with their restored contents),
+other items as full copies.  Historical objects are deactivated once
+copied (folders, once their contents are), and the transaction is
+committed at checkpoints, after which both connections' caches are
+garbage collected, so that memory used stays bounded by the depth of
+the subtree, not its size.
+
+Items already present in the live site (by id, in their container) are
+not copied again, but folders are descended into, so a restore
+interrupted after a checkpoint is resumed by running it again.
+"""
+
+import logging
+
+from Acquisition import aq_base
+from plone.dexterity.interfaces import IDexterityContent
+import transaction
+
+from plone.wabac.restore.content import full_copy, shallow_copy
+
+
+logger = logging.getLogger('plone.wabac')
+
+
+# Default number of items restored per transaction:
+CHECKPOINT = 500
+
+
+def folderish(ob):
+    return bool(getattr(aq_base(ob), 'isPrincipiaFolderish', False))
+
+
+class SubtreeRestore(object):
+    """
+    Depth-first restoration of historical content source, and contents,
+    into live container, committing after every 'checkpoint' items
+    copied (items copied since are left for the caller to commit);
+    optional report callable is called with the number of items copied
+    so far after each commit.
+    """
+
+    def __init__(self, source, container, checkpoint=CHECKPOINT,
+                 report=None):
+        self.source = source
+        self.container = container
+        self.checkpoint = checkpoint
+        self.report = report
+        self.copied = 0
+
+    def copy(self, source, container):
+        """Live copy of historical source in container, unless present"""
+        name = source.getId()
+        existing = container._getOb(name, None)
+        if existing is not None:
+            return existing
+        if folderish(source) and IDexterityContent.providedBy(source):
+            ob = shallow_copy(source, container)
+        else:
+            ob = full_copy(source, container)
+        container._setObject(name, ob, set_owner=0)
+        self.copied += 1
+        if not self.copied % self.checkpoint:
+            self.commit()
+        return container._getOb(name)
+
+    def commit(self):
+        transaction.commit()
+        for jar in (self.source._p_jar, self.container._p_jar):
+            jar.cacheGC()
+        logger.info('Restored %s items', self.copied)
+        if self.report is not None:
+            self.report(self.copied)
+
+    def run(self):
+        """Restore subtree, return number of items copied"""
+        target = self.copy(self.source, self.container)
+        if not (folderish(self.source) and folderish(target)):
+            return self.copied
+        # (historical folder, live folder, ids of contents to copy):
+        stack = [(self.source, target, iter(self.source.objectIds()))]
+        while stack:
+            source, target, ids = stack[-1]
+            name = next(ids, None)
+            if name is None:
+                stack.pop()
+                source._p_deactivate()  # contents all copied
+                continue
+            child = source._getOb(name)
+            if folderish(child):
+                live = self.copy(child, target)
+                if folderish(live):
+                    stack.append((child, live, iter(child.objectIds())))
+                    continue
+            else:
+                self.copy(child, target)
+            child._p_deactivate()
+        return self.copied
@@ -1,13 +1,29 @@
 # modificaiton log and enumeration testing
 
-from datetime import datetime
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import cPickle
+import csv
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import time
+import transaction
 import unittest
 
+from Acquisition import aq_base
 from plone import api
 from plone.app.testing import TEST_USER_ID, TEST_USER_NAME
 from plone.app.testing import setRoles, login
 from plone.uuid.interfaces import IUUID
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+from zExceptions import Forbidden
+from zope.annotation.interfaces import IAnnotations
 from zope.lifecycleevent import ObjectModifiedEvent
 from zope.lifecycleevent import ObjectMovedEvent, ObjectRemovedEvent
 from zope.event import notify
@@ -15,6 +31,16 @@ from zope.event import notify
 from plone.wabac.modlog.interfaces import IModificationLogger
 from plone.wabac.modlog.interfaces import IChangeEnumeration
 from plone.wabac.modlog import ModificationLogger, ChangesetView
+from plone.wabac.modlog import benchmark, handlers, instrument, keys
+from plone.wabac.modlog import loadtest, segments
+from plone.wabac.modlog.backends import ANNO_KEY
+from plone.wabac.modlog.export import FIELDS, export_chunks, export_values
+from plone.wabac.modlog.export import parse_time
+from plone.wabac.modlog.keys import KeyClock, SEQ_MASK, slot_of
+from plone.wabac.modlog.records import ChangeRecord, ChildManifest
+from plone.wabac.modlog.records import TransactionMarker
+from plone.wabac.modlog.records import expand_descendants
+from plone.wabac.modlog.testing import StandInContent, stand_in_database
 from plone.wabac.testing import PLONE_WABAC_INTEGRATION_TESTING  # noqa
 
 
@@ -38,6 +64,41 @@ class TestModificationLogging(unittest.TestCase):
             container=self.portal,
             )
     
+    def test_prune_view(self):
+        """Test pruning view confirms by form, requires authenticator"""
+        logger = IModificationLogger(self.portal)
+        handlers.flush()
+        added = len(logger.additions)
+        self.assertTrue(added)
+        request = self.layer['request']
+        request.form.update(days='0')
+        view = self.portal.restrictedTraverse('@@modlog-prune')
+        self.assertIn('name="_authenticator"', view())
+        self.assertEqual(len(logger.additions), added)
+        request['REQUEST_METHOD'] = 'POST'
+        self.assertRaises(Forbidden, view)
+        self.assertEqual(len(logger.additions), added)
+
+    def test_export_view_cache(self):
+        """Test export keeps site objects cached when sharing connection"""
+        logger = IModificationLogger(self.portal)
+        handlers.flush()
+        logger.prune(None, days=0)
+        for i in range(3):
+            logger.log('modify', self.content1)
+        transaction.savepoint()  # content now unmodified, ghostable
+        self.content1.Title()  # loaded
+        request = self.layer['request']
+        request.form.update(facility='modifications')
+        request.response.stdout = StringIO()
+        view = self.portal.restrictedTraverse('@@modlog-export')
+        view.chunk = 1
+        view()
+        output = request.response.stdout.getvalue()
+        self.assertEqual(output.count(IUUID(self.content1)), 3)
+        self.assertIsNotNone(aq_base(self.content1)._p_changed)
+        logger.prune(None, days=0)
+
     def test_adaptation(self):
         """Test ModificationLogger adapts site, tests registration"""
         logger = IModificationLogger(self.portal)
@@ -92,9 +153,173 @@ class TestModificationLogging(unittest.TestCase):
         logger.prune('modifications', days=0.0000001)
         self.assertTrue(len(facility) == 0)
 
+    def test_prune_range(self):
+        """Test pruning removes only records older than timespec"""
+        logger = IModificationLogger(self.portal)
+        logger.prune(None, days=0)
+        for i in range(5):
+            logger.modified(self.content1, user='bob')
+        time.sleep(0.01)
+        timespec = datetime.now()
+        for i in range(3):
+            logger.modified(self.content2, user='bob')
+        facility = logger.modifications
+        self.assertEqual(len(facility), 8)
+        # facility name may be given in verb form:
+        logger.prune('modify', timespec=timespec)
+        self.assertEqual(len(facility), 3)
+        self.assertEqual(len(facility.keys()), 3)
+        for record in facility.values():
+            self.assertTrue(record.get('when') >= timespec)
+        self.assertEqual(len(list(facility.limit({'user': 'bob'}))), 3)
+        uid = IUUID(self.content1)
+        self.assertEqual(list(facility.limit({'uid': uid})), [])
+        logger.prune(None, days=0)
+
+    def test_iterprune(self):
+        """Test chunked pruning yields per-chunk progress"""
+        logger = IModificationLogger(self.portal)
+        logger.prune(None, days=0)
+        for i in range(5):
+            logger.modified(self.content1)
+        logger.deleted(self.content2)
+        steps = logger.iterprune(None, days=0, chunk=2)
+        # facilities are pruned lazily, one chunk at a time:
+        self.assertEqual(len(logger.modifications), 5)
+        name, removed = next(steps)
+        self.assertEqual(removed, 1 if name == 'deletions' else 2)
+        result = [(name, removed)] + list(steps)
+        self.assertEqual(
+            sorted(result),
+            [('deletions', 1), ('modifications', 1),
+             ('modifications', 2), ('modifications', 2)]
+            )
+        self.assertEqual(len(logger.modifications), 0)
+        self.assertEqual(len(logger.deletions), 0)
+
+    def test_lifo_order(self):
+        """Test enumeration is newest-first, keys are time-ordered"""
+        logger = IModificationLogger(self.portal)
+        logger.prune(None, days=0)
+        for i in range(5):
+            logger.modified(self.content1)
+            logger.modified(self.content2)
+        facility = logger.modifications
+        self.assertEqual(len(facility), 10)
+        keys = facility.keys()
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), 10)
+        self.assertIn(keys[0], facility)
+        self.assertNotIn(keys[0] - 1, facility)
+        paths = [r.get('path') for r in facility.values()]
+        self.assertEqual(
+            paths[:2],
+            ['/'.join(c.getPhysicalPath())
+             for c in (self.content2, self.content1)]
+            )
+        whens = [r.get('when') for r in facility.values()]
+        self.assertEqual(whens, sorted(whens, reverse=True))
+        logger.prune(None, days=0)
+
+    def test_limit(self):
+        """Test filtered enumeration, by index and by prefix"""
+        logger = IModificationLogger(self.portal)
+        logger.prune(None, days=0)
+        uid1, uid2 = IUUID(self.content1), IUUID(self.content2)
+        for i in range(3):
+            logger.modified(self.content1, user='bob')
+            logger.modified(self.content2, user='alice')
+        logger.modified(self.content1, user='alice')
+        facility = logger.modifications
+        self.assertEqual(len(list(facility.limit())), 7)
+        self.assertEqual(len(list(facility.limit({'user': 'bob'}))), 3)
+        self.assertEqual(len(list(facility.limit({'uid': uid2}))), 3)
+        result = list(facility.limit({'uid': uid1, 'user': 'alice'}))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].get('uid'), uid1)
+        self.assertEqual(list(facility.limit({'user': 'nobody'})), [])
+        # LIFO order, and batching by start:
+        result = list(facility.limit({'user': 'alice'}))
+        self.assertEqual([r.get('uid') for r in result][:2], [uid1, uid2])
+        batch = list(facility.limit({'user': 'alice'}, 1))
+        self.assertEqual(batch, result[1:])
+        # path prefix, alone or combined with indexed filters:
+        path = '/'.join(self.content2.getPhysicalPath())
+        self.assertEqual(len(list(facility.limit({'path': path}))), 3)
+        result = facility.limit({'path': path, 'user': 'bob'})
+        self.assertEqual(list(result), [])
+        # pruned records are removed from indexes:
+        logger.prune(None, days=0)
+        self.assertEqual(list(facility.limit({'user': 'bob'})), [])
+
+    def test_batch_cursor(self):
+        """Test cursor batching is stable as new records are logged"""
+        logger = IModificationLogger(self.portal)
+        logger.prune(None, days=0)
+        for i in range(4):
+            logger.modified(self.content1, user='bob')
+            logger.modified(self.content2, user='alice')
+        facility = logger.modifications
+        expected = list(facility.limit({'user': 'bob'}))
+        records, cursor = facility.batch({'user': 'bob'}, size=3)
+        self.assertEqual(records, expected[:3])
+        # newer records do not shift following batches:
+        logger.modified(self.content1, user='bob')
+        records, cursor = facility.batch({'user': 'bob'}, cursor, size=3)
+        self.assertEqual(records, expected[3:])
+        self.assertIsNone(cursor)
+        # cursor may also be passed to limit as start:
+        records, cursor = facility.batch(size=2)
+        self.assertEqual(
+            list(facility.limit(None, cursor)),
+            facility.values()[2:]
+            )
+        # cursors are only valid for filters they were made with:
+        self.assertRaises(ValueError, facility.batch, {'user': 'bob'}, cursor)
+        self.assertRaises(ValueError, facility.batch, None, 'bogus')
+        logger.prune(None, days=0)
+
+    def test_limit_subtree(self):
+        """Test path prefix filtering stays correct on insert, prune"""
+        logger = IModificationLogger(self.portal)
+        logger.prune(None, days=0)
+        folder = api.content.create(
+            type='Folder',
+            title='Finance',
+            container=self.portal,
+            )
+        children = [
+            api.content.create(type='Document', title=title, container=folder)
+            for title in ('Budget', 'Report')
+            ]
+        logger.prune(None, days=0)
+        for content in [folder, self.content1] + children:
+            logger.deleted(content)
+        facility = logger.deletions
+        path = '/'.join(folder.getPhysicalPath())
+        result = list(facility.limit({'path': path}))
+        self.assertEqual(len(result), 3)
+        self.assertEqual(
+            [r.get('uid') for r in result],
+            [IUUID(c) for c in reversed([folder] + children)]
+            )
+        result = list(facility.limit({'path': path + '/'}))
+        self.assertEqual(len(result), 2)
+        uid = IUUID(children[0])
+        result = list(facility.limit({'path': path, 'uid': uid}))
+        self.assertEqual(len(result), 1)
+        logger.prune(None, days=0)
+        self.assertEqual(list(facility.limit({'path': path})), [])
+        logger.deleted(children[1])
+        result = list(facility.limit({'path': path}))
+        self.assertEqual([r.get('uid') for r in result], [IUUID(children[1])])
+        logger.prune(None, days=0)
+
     def test_handlers(self):
         logger = IModificationLogger(self.portal)
-        # guarantee that everything is initially empty by pruning days=0
+        # log changes queued by setUp, then guarantee that everything is
+        # initially empty by pruning days=0
+        handlers.flush()
         logger.prune(None, days=0)
         for name in ('modifications', 'moves', 'deletions', 'additions'):
             facility = getattr(logger, name)
@@ -107,18 +332,34 @@ class TestModificationLogging(unittest.TestCase):
             container=self.portal,
             )
         uid = IUUID(content)
+        # changes are queued until commit (or flush):
+        self.assertFalse(len(logger.additions))
+        handlers.flush()
         # api will have notified ObjectAddedEvent by effect, let's verify:
         self.assertTrue(len(logger.additions) == 1)
         self.assertTrue(logger.additions.values()[0].get('uid') == uid)
-        # api create will have also renamed the item, logging a move:
-        self.assertTrue(len(logger.moves.keys()) == 1)
+        self.assertEqual(
+            logger.additions.values()[0].get('portal_type'),
+            'Document',
+            )
+        self.assertEqual(logger.additions.counts('portal_type'), {
+            'Document': 1,
+            })
+        # api create will have also renamed the item, which is coalesced
+        # into the addition, logged with final path:
+        self.assertFalse(len(logger.moves.keys()))
+        self.assertEqual(
+            logger.additions.values()[0].get('path'),
+            '/'.join(content.getPhysicalPath())
+            )
         # modification logging:
         self.assertFalse(len(logger.modifications.keys()))
         notify(ObjectModifiedEvent(content))
+        handlers.flush()
         self.assertTrue(len(logger.modifications.keys()))
         self.assertTrue(logger.modifications.values()[0].get('uid') == uid)
         # move/rename logging:
-        self.assertTrue(len(logger.moves.keys()) == 1)
+        self.assertFalse(len(logger.moves.keys()))
         notify(ObjectMovedEvent(
             content,
             self.portal,
@@ -126,11 +367,906 @@ class TestModificationLogging(unittest.TestCase):
             self.portal,
             'haha'
             ))
-        self.assertTrue(len(logger.moves.keys()) == 2)
+        handlers.flush()
+        self.assertTrue(len(logger.moves.keys()) == 1)
         # finally removal:
         self.assertFalse(len(logger.deletions.keys()))
         notify(ObjectRemovedEvent(content))
+        handlers.flush()
         self.assertTrue(len(logger.deletions.keys()))
         self.assertTrue(logger.deletions.values()[0].get('uid') == uid)
         # clean up after testing:
         logger.prune(None, days=0)
+
+    def test_handlers_coalesce(self):
+        """Test changes in one transaction are coalesced per item"""
+        logger = IModificationLogger(self.portal)
+        handlers.flush()
+        logger.prune(None, days=0)
+        # added, modified, then deleted in transaction: nothing logged
+        content = api.content.create(
+            type='Document',
+            title='Ephemeral',
+            container=self.portal,
+            )
+        ephemeral = IUUID(content)
+        notify(ObjectModifiedEvent(content))
+        api.content.delete(content)
+        # repeated modifications, then a move, of existing content:
+        for i in range(3):
+            notify(ObjectModifiedEvent(self.content1))
+        api.content.rename(self.content1, new_id='renamed')
+        # modified, then deleted:
+        notify(ObjectModifiedEvent(self.content2))
+        api.content.delete(self.content2)
+        handlers.flush()
+        self.assertEqual(len(logger.additions), 0)
+        for name in ('modifications', 'moves', 'deletions'):
+            facility = getattr(logger, name)
+            self.assertEqual(list(facility.limit({'uid': ephemeral})), [])
+        uid1, uid2 = IUUID(self.content1), IUUID(self.content2)
+        modified = list(logger.modifications.limit({'uid': uid1}))
+        self.assertEqual(len(modified), 1)
+        moved = list(logger.moves.limit({'uid': uid1}))
+        self.assertEqual(len(moved), 1)
+        path = '/'.join(self.content1.getPhysicalPath())
+        self.assertEqual(moved[0].get('path'), path)
+        self.assertEqual(list(logger.modifications.limit({'uid': uid2})), [])
+        self.assertEqual(len(list(logger.deletions.limit({'uid': uid2}))), 1)
+        logger.prune(None, days=0)
+
+    def test_handlers_subtree(self):
+        """Test folder removal is logged as one record with manifest"""
+        logger = IModificationLogger(self.portal)
+        folder = api.content.create(
+            type='Folder',
+            title='Folder',
+            container=self.portal,
+            )
+        sub = api.content.create(type='Folder', title='Sub', container=folder)
+        pages = [
+            api.content.create(type='Document', title='Page', container=c)
+            for c in (folder, sub, sub)
+            ]
+        handlers.flush()
+        logger.prune(None, days=0)
+        path = '/'.join(folder.getPhysicalPath())
+        expected = dict(
+            (IUUID(o), '/'.join(o.getPhysicalPath()))
+            for o in [sub] + pages
+            )
+        uid = IUUID(folder)
+        api.content.delete(folder)
+        handlers.flush()
+        self.assertEqual(len(logger.deletions), 1)
+        record = logger.deletions.values()[0]
+        self.assertEqual(record.get('uid'), uid)
+        self.assertEqual(record.get('path'), path)
+        manifest = record.get('extra')['descendants']
+        self.assertEqual(len(manifest), len(expected))
+        expanded = list(logger.deletions.limit(expand=True))
+        self.assertEqual(expanded[0], record)
+        self.assertEqual(
+            dict((r.get('uid'), r.get('path')) for r in expanded[1:]),
+            expected,
+            )
+        for descendant in expanded[1:]:
+            self.assertEqual(descendant.get('extra'), {'ancestor': uid})
+            self.assertEqual(descendant.get('when'), record.get('when'))
+        logger.prune(None, days=0)
+
+    def test_handlers_savepoint(self):
+        """Test changes rolled back to a savepoint are not logged"""
+        logger = IModificationLogger(self.portal)
+        removed = ObjectRemovedEvent(
+            self.content2,
+            self.portal,
+            self.content2.getId(),
+            )
+        handlers.flush()
+        logger.prune(None, days=0)
+        notify(ObjectModifiedEvent(self.content1))
+        savepoint = transaction.savepoint()
+        notify(ObjectModifiedEvent(self.content1))
+        notify(ObjectModifiedEvent(self.content2))
+        notify(removed)
+        savepoint.rollback()
+        notify(ObjectModifiedEvent(self.content2))
+        savepoint.rollback()  # again, to the same state
+        handlers.flush()
+        self.assertFalse(len(logger.deletions))
+        self.assertEqual(
+            [r.get('uid') for r in logger.modifications.values()],
+            [IUUID(self.content1)],
+            )
+        # savepoint made before the queue joined the transaction:
+        savepoint = transaction.savepoint()
+        notify(removed)
+        savepoint.rollback()
+        handlers.flush()
+        self.assertFalse(len(logger.deletions))
+        logger.prune(None, days=0)
+
+    def test_handlers_late_changes(self):
+        """Test changes made by later before-commit hooks are logged"""
+        logger = IModificationLogger(self.portal)
+        removed = ObjectRemovedEvent(
+            self.content2,
+            self.portal,
+            self.content2.getId(),
+            )
+        handlers.flush()
+        logger.prune(None, days=0)
+        txn = transaction.get()
+        notify(ObjectModifiedEvent(self.content1))
+        # hook added after the queue's flush, changing content again:
+        txn.addBeforeCommitHook(notify, (removed,))
+        # run before-commit hooks as commit does, including any added
+        # while running them:
+        for hook, args, kwargs in txn.getBeforeCommitHooks():
+            hook(*args, **kwargs)
+        self.assertEqual(len(logger.modifications), 1)
+        self.assertEqual(
+            logger.deletions.values()[0].get('uid'),
+            IUUID(self.content2),
+            )
+        # once committing, changes are reported, not queued:
+        current = handlers.queue()
+        current.tpc_begin(txn)
+        notify(ObjectModifiedEvent(self.content2))
+        self.assertFalse(current.sites)
+        current.committing = False
+        logger.prune(None, days=0)
+
+    def test_handlers_logger_reuse(self):
+        """Test logger is reused within, not across, transactions"""
+        current = handlers.queue()
+        logger = current.logger(self.portal)
+        self.assertIs(handlers.queue(), current)
+        self.assertIs(current.logger(self.portal), logger)
+        self.assertIs(logger.modifications, logger.modifications)
+        self.assertIs(logger.storage(create=True), logger.storage())
+        self.assertEqual(logger.current_user(), TEST_USER_NAME)
+        logger.log('modify', self.content1)
+        facility = logger.modifications
+        self.assertIs(facility, logger._facility('modifications'))
+        transaction.abort()
+        self.assertIsNot(logger.modifications, facility)
+        self.assertIsNot(handlers.queue(), current)
+        self.assertIsNot(handlers.queue().logger(self.portal), logger)
+
+
+class TestRecordKeys(unittest.TestCase):
+    """Tests for record key generation"""
+
+    def test_monotonic(self):
+        """Test keys are unique, LIFO-ordered even if clock stalls"""
+        clock = KeyClock()
+        now = datetime.now()
+        issued = [clock.next_key(now, 3) for i in range(SEQ_MASK + 10)]
+        issued.append(clock.next_key(now + timedelta(seconds=1), 3))
+        self.assertEqual(len(set(issued)), len(issued))
+        self.assertEqual(issued, sorted(issued, reverse=True))
+        self.assertEqual(set(slot_of(k) for k in issued), set([3]))
+
+    def test_backdated(self):
+        """Test records logged earlier are keyed at their own time"""
+        clock = KeyClock()
+        now = datetime.now()
+        newest = clock.next_key(now, 3)
+        earlier = now - timedelta(days=100)
+        key = clock.next_key(earlier, 3)
+        self.assertTrue(key > newest)
+        self.assertEqual(-key >> keys.STAMP_SHIFT, keys.epoch_ms(earlier))
+        self.assertEqual(slot_of(key), 3)
+        self.assertEqual(
+            keys.partition_of(key),
+            keys.month_partition(earlier),
+            )
+        # should key be taken, the next in sequence follows:
+        self.assertEqual(clock.next_after(key), key - 1)
+        # ...without affecting keys of records logged now:
+        self.assertEqual(clock.next_key(now, 3), newest - 1)
+
+
+class TestChangeRecord(unittest.TestCase):
+    """Tests for compact change record type"""
+
+    uid = 'd4c5e1b3e48e4d3c9a4b1bbfd5e7a2c1'
+
+    path = '/plone/folder/page'
+
+    def test_mapping(self):
+        """Test read-only mapping API of records"""
+        when = datetime.now()
+        record = ChangeRecord.create(self.uid, self.path, 'bob', when)
+        self.assertEqual(record.keys(), ['uid', 'path', 'user', 'when'])
+        self.assertEqual(record.get('uid'), self.uid)
+        self.assertEqual(record['path'], self.path)
+        self.assertEqual(record.get('user'), 'bob')
+        self.assertEqual(record.get('when'), when)
+        self.assertIsNone(record.get('extra'))
+        self.assertEqual(record.get('extra', {}), {})
+        self.assertRaises(KeyError, lambda: record['extra'])
+        record = ChangeRecord.create(u'custom-uid', '/x', 'bob', when, {1: 2})
+        self.assertEqual(record.get('uid'), u'custom-uid')
+        self.assertEqual(record.get('extra'), {1: 2})
+        self.assertIn('extra', record.keys())
+        self.assertNotIn('portal_type', record.keys())
+        record = ChangeRecord.create(
+            self.uid, self.path, 'bob', when, portal_type='Document')
+        self.assertEqual(record.get('portal_type'), 'Document')
+        self.assertEqual(record.keys()[-1], 'portal_type')
+        self.assertIsNone(record.get('extra'))
+        self.assertEqual(cPickle.loads(cPickle.dumps(record, 1)), record)
+        serial = '\x03\xb4' + '\x00' * 6
+        record = ChangeRecord.create(
+            self.uid, self.path, 'bob', when, serial=serial)
+        self.assertEqual(record.keys()[-1], 'serial')
+        self.assertEqual(record.get('serial'), serial)
+        self.assertIsNone(record.get('tid'))
+        record = ChangeRecord.create(
+            self.uid, self.path, 'bob', when, marker=TransactionMarker())
+        self.assertEqual(record.keys()[-1], 'tid')
+        self.assertIsNone(record.get('tid'))  # not committed
+
+    def test_pickle(self):
+        """Test records pickle compactly, and round-trip"""
+        when = datetime.now()
+        record = ChangeRecord.create(self.uid, self.path, 'bob', when)
+        data = cPickle.dumps(record, 1)
+        self.assertEqual(cPickle.loads(data), record)
+        self.assertEqual(cPickle.loads(data).get('when'), when)
+        plain = dict(uid=self.uid, path=self.path, user='bob', when=when)
+        self.assertTrue(len(data) < len(cPickle.dumps(plain, 1)))
+        # records of one transaction share the tuple referencing its
+        # marker, pickled once (memoized):
+        marker = TransactionMarker()
+        records = [
+            ChangeRecord.create(
+                self.uid, self.path, 'bob', when, marker=marker)
+            for i in range(2)
+            ]
+        self.assertIs(records[0].marker, marker)
+        self.assertIs(tuple.__getitem__(records[1], 7), marker.reference())
+        references = []
+
+        def persistent_id(ob):
+            if ob is marker:
+                references.append(ob)
+                return 'marker'
+            return None
+
+        pickler = cPickle.Pickler(StringIO(), 1)
+        pickler.persistent_id = persistent_id
+        pickler.dump(records)
+        self.assertEqual(len(references), 1)
+
+    def test_expand_descendants(self):
+        """Test records of folder removal expand to descendants"""
+        when = datetime.now()
+        manifest = ChildManifest(
+            '/plone/folder',
+            OrderedDict([(self.uid, self.path), (u'x', '/plone/folder/a/b')]),
+            )
+        self.assertEqual(
+            list(manifest),
+            [(self.uid, 'page'), (u'x', 'a/b')],
+            )
+        uid = 'f' * 32
+        record = ChangeRecord.create(
+            uid, '/plone/folder', 'bob', when, {'descendants': manifest})
+        other = ChangeRecord.create(u'y', '/plone/other', 'bob', when)
+        expanded = list(expand_descendants([record, other]))
+        self.assertEqual(len(expanded), 4)
+        self.assertEqual(expanded[0], record)
+        self.assertEqual(expanded[3], other)
+        self.assertEqual(expanded[1].get('path'), self.path)
+        self.assertEqual(expanded[2].get('path'), '/plone/folder/a/b')
+        self.assertEqual(expanded[2].get('uid'), u'x')
+        self.assertEqual(expanded[2].get('extra'), {'ancestor': uid})
+        self.assertEqual(expanded[2].get('when'), when)
+
+
+class TestPartitions(unittest.TestCase):
+    """Tests for monthly partitions of facility storage"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database()
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.logger = ModificationLogger(self.conn.get(self.site_oid))
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_partitions(self):
+        """Test records partitioned by month, pruned whole partitions"""
+        now = datetime.now()
+        months = [now - timedelta(days=31 * n) for n in (3, 2, 1, 0)]
+        for when in months:
+            for i in range(3):
+                self.logger.log_change(
+                    'modify', u'uid%s' % i, '/plone/page', 'bob', None, when)
+        self.tm.commit()
+        facility = self.logger.modifications
+        partitions = facility._storage()
+        self.assertEqual(len(partitions), 4)
+        self.assertEqual(
+            list(partitions.keys()),
+            sorted(keys.month_partition(when) for when in months),
+            )
+        self.assertEqual(len(facility), 12)
+        stamps = [r.get('when') for r in facility.values()]
+        self.assertEqual(stamps, sorted(stamps, reverse=True))
+        self.assertEqual(stamps[0], months[-1])
+        cursor = facility.batch(size=5)[1]
+        self.assertEqual(len(list(facility.limit(start=cursor))), 7)
+        removed = self.logger.prune('modify', timespec=months[1])
+        self.assertEqual(removed, {u'modifications': 3})
+        self.assertEqual(len(partitions), 3)
+        self.assertEqual(len(facility), 9)
+        timespec = months[2] + timedelta(microseconds=1)
+        self.assertEqual(facility.prune(timespec), 6)
+        self.assertEqual(len(partitions), 2)
+        self.assertEqual(
+            [r.get('when') for r in facility.values()],
+            [months[-1]] * 3,
+            )
+        # backdated records, logged after newer ones, are partitioned
+        # and pruned by their own time:
+        earlier = now - timedelta(days=100)
+        self.logger.log_change(
+            'modify', u'old', '/plone/page', 'bob', None, earlier)
+        self.assertEqual(len(partitions), 3)
+        self.assertEqual(facility.values()[-1].get('when'), earlier)
+        self.assertEqual(self.logger.prune('modify', days=50), {
+            u'modifications': 1,
+            })
+        self.assertEqual(len(partitions), 2)
+
+    def test_transaction_ids(self):
+        """Test records keep tid of logging transaction, content serial"""
+        site = self.conn.get(self.site_oid)
+        serial = site._p_serial
+        manifest = ChildManifest('/plone', {'a' * 32: '/plone/f/a'})
+        self.logger.log_change(
+            'delete', u'uid1', '/plone/f', 'bob', {'descendants': manifest},
+            serial=serial)
+        self.logger.log_change('modify', u'uid2', '/plone/p', 'bob')
+        self.tm.commit()
+        tid = self.db.lastTransaction()
+        self.assertNotEqual(tid, serial)
+        deleted = self.logger.deletions.values()[0]
+        self.assertEqual(deleted.get('tid'), tid)
+        self.assertEqual(deleted.get('serial'), serial)
+        modified = self.logger.modifications.values()[0]
+        self.assertEqual(modified.get('tid'), tid)
+        self.assertIsNone(modified.get('serial'))
+        expanded = list(self.logger.deletions.limit(expand=True))
+        self.assertEqual([r.get('tid') for r in expanded], [tid, tid])
+        # records logged by a later transaction have its tid:
+        self.logger.log_change('modify', u'uid2', '/plone/p', 'bob')
+        self.tm.commit()
+        tids = [r.get('tid') for r in self.logger.modifications.values()]
+        self.assertEqual(tids, [self.db.lastTransaction(), tid])
+        self.assertTrue(tids[0] > tid)
+
+    def test_descendant_filters(self):
+        """Test removal of a folder found by uids and paths removed"""
+        descendants = {'a' * 32: '/plone/f/a', 'b' * 32: '/plone/f/a/b'}
+        manifest = ChildManifest('/plone/f', descendants)
+        self.logger.log_change(
+            'delete', u'f' * 32, '/plone/f', 'bob', {'descendants': manifest},
+            datetime.now() - timedelta(days=1))
+        self.logger.log_change('delete', u'c' * 32, '/plone/c', 'bob')
+        deletions = self.logger.deletions
+        for filters in ({'uid': u'b' * 32}, {'path': '/plone/f/a/'}):
+            records = list(deletions.limit(filters))
+            self.assertEqual([r.get('uid') for r in records], [u'f' * 32])
+            records = list(deletions.limit(filters, expand=True))
+            self.assertEqual([r.get('uid') for r in records], [u'b' * 32])
+            self.assertEqual(records[0].get('extra'), {'ancestor': u'f' * 32})
+        for index in deletions._segment(deletions.keys()[0]).indexes.values():
+            self.assertNotIn('a' * 32, index)
+            self.assertNotIn('/plone/f/a', index)
+        self.assertEqual(len(list(deletions.limit({'path': '/plone/f'}))), 1)
+        self.assertEqual(
+            len(list(deletions.limit({'path': '/plone/f'}, expand=True))),
+            3,
+            )
+        # counted once, as logged:
+        self.assertEqual(deletions.counts('user'), {'bob': 2})
+        # pruned with the folder record:
+        self.assertEqual(self.logger.prune('delete', days=0.5), {
+            u'deletions': 1,
+            })
+        self.assertEqual(list(deletions.limit({'uid': u'a' * 32})), [])
+        self.assertEqual(list(deletions.limit({'path': '/plone/f/a'})), [])
+
+    def test_large_removal(self):
+        """Test removal of a large folder stores few persistent objects"""
+        self.logger.log_change('delete', u'c' * 32, '/plone/c', 'bob')
+        self.tm.commit()  # (partition created)
+        objects = self.db.objectCount()
+        descendants = dict(
+            ('%032x' % n, '/plone/f/%s' % n) for n in range(10000))
+        manifest = ChildManifest('/plone/f', descendants)
+        self.logger.log_change(
+            'delete', u'f' * 32, '/plone/f', 'bob', {'descendants': manifest})
+        self.tm.commit()
+        # not one (or more) per descendant:
+        self.assertLess(self.db.objectCount() - objects, 1000)
+        deletions = self.logger.deletions
+        for filters in ({'uid': '%032x' % 5000}, {'path': '/plone/f/5000'}):
+            records = list(deletions.limit(filters))
+            self.assertEqual([r.get('uid') for r in records], [u'f' * 32])
+
+    def test_time_range(self):
+        """Test since/until queries scan only records in time window"""
+        now = datetime.now()
+        days = [now - timedelta(days=n) for n in range(60, -1, -1)]
+        for i, when in enumerate(days):
+            user = 'bob' if i % 2 else 'alice'
+            self.logger.log_change(
+                'modify', u'uid%s' % i, '/plone/page', user, None, when)
+        self.tm.commit()
+        facility = self.logger.modifications
+        since, until = days[10], days[40]
+        selected = list(facility.limit(since=since, until=until))
+        self.assertEqual(
+            [r.get('when') for r in selected],
+            list(reversed(days[10:40])),
+            )
+        bob = list(facility.limit({'user': 'bob'}, since=since, until=until))
+        self.assertEqual(len(bob), 15)
+        self.assertTrue(all(r.get('user') == 'bob' for r in bob))
+        self.assertEqual(len(list(facility.limit(since=days[-1]))), 1)
+        self.assertEqual(len(list(facility.limit(until=days[1]))), 1)
+        self.assertEqual(list(facility.limit(since=until, until=since)), [])
+        # records outside the window are not loaded, except that logged
+        # in the millisecond of until:
+        probe = instrument.Probe('limit', facility.__name__)
+        items = facility._select(None, None, probe, since, until)
+        self.assertEqual(len(list(items)), 30)
+        self.assertEqual(probe.counts['scanned'], 31)
+        # batches, resumed within the window:
+        page, cursor = facility.batch(size=20, since=since, until=until)
+        rest, cursor = facility.batch(None, cursor, 20, since, until)
+        self.assertEqual(page + rest, selected)
+        self.assertIsNone(cursor)
+        # backdated records, logged after newer ones, by their own time:
+        earlier = now - timedelta(days=100)
+        self.logger.log_change(
+            'modify', u'old', '/plone/page', 'bob', None, earlier)
+        window = facility.limit(
+            since=earlier - timedelta(days=1),
+            until=earlier + timedelta(days=1),
+            )
+        self.assertEqual([r.get('uid') for r in window], [u'old'])
+        older = list(facility.limit(until=now - timedelta(days=50)))
+        self.assertEqual(
+            [r.get('when') for r in older],
+            list(reversed(days[:10])) + [earlier],
+            )
+
+
+class TestExport(unittest.TestCase):
+    """Tests for streaming export of records"""
+
+    def records(self, count):
+        start = datetime(2016, 1, 1)
+        return [
+            ChangeRecord.create(
+                '%032x' % i,
+                u'/plone/p\xe9ge%s' % i,
+                'bob',
+                start - timedelta(days=i),
+                {'n': i} if i % 2 else None,
+                )
+            for i in range(count)
+            ]
+
+    def test_jsonl(self):
+        """Test JSON lines export, in chunks"""
+        consumed = []
+        chunks = list(
+            export_chunks(
+                self.records(5),
+                'jsonl',
+                size=2,
+                after_chunk=lambda: consumed.append(1),
+                )
+            )
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(len(consumed), 3)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(len(lines), 5)
+        first, second = json.loads(lines[0]), json.loads(lines[1])
+        self.assertEqual(first['path'], u'/plone/p\xe9ge0')
+        self.assertEqual(first['when'], '2016-01-01T00:00:00')
+        self.assertIsNone(first['extra'])
+        self.assertEqual(second['extra'], {'n': 1})
+
+    def test_csv(self):
+        """Test CSV export, with header row, UTF-8 encoded"""
+        data = ''.join(export_chunks(self.records(3), 'csv'))
+        rows = list(csv.reader(StringIO(data)))
+        self.assertEqual(rows[0], list(FIELDS))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][1], u'/plone/p\xe9ge0'.encode('utf-8'))
+        self.assertEqual(rows[2][4], '{"n": 1}')
+        empty = ''.join(export_chunks([], 'csv'))
+        self.assertEqual(empty, ','.join(FIELDS) + '\r\n')
+
+    def test_parse_time(self):
+        """Test times given for export, and manifest counts"""
+        since = parse_time('2015-12-25')
+        self.assertEqual(since, datetime(2015, 12, 25))
+        self.assertEqual(
+            parse_time('2015-12-25T10:30'),
+            datetime(2015, 12, 25, 10, 30),
+            )
+        self.assertRaises(ValueError, parse_time, 'yesterday')
+        manifest = ChildManifest('/plone', {'a': '/plone/a'})
+        record = ChangeRecord.create(
+            'x', '/plone', 'bob', since, {'descendants': manifest})
+        self.assertEqual(export_values(record)['extra'], {'descendants': 1})
+
+
+class TestDatabaseStorage(unittest.TestCase):
+    """Tests for modification log storage in a separate database"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database(log_database='modlog')
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.site = self.conn.get(self.site_oid)
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_database_storage(self):
+        """Test log kept in named database, not site annotations"""
+        logger = ModificationLogger(self.site, database='modlog')
+        content = StandInContent(self.site, 'page')
+        logger.modified(content, user='bob')
+        self.tm.commit()
+        self.assertNotIn(ANNO_KEY, IAnnotations(self.site))
+        storage = logger.storage()
+        self.assertIs(storage._p_jar, self.conn.get_connection('modlog'))
+        root = self.conn.get_connection('modlog').root()
+        self.assertIs(root[ANNO_KEY]['/plone'], storage)
+        # read back in another connection:
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        try:
+            site = conn.get(self.site_oid)
+            logger = ModificationLogger(site, database='modlog')
+            records = logger.modifications.values()
+            self.assertEqual([r.get('user') for r in records], ['bob'])
+            self.assertIsNone(ModificationLogger(site).storage())
+        finally:
+            conn.close()
+
+    def test_markers(self):
+        """Test markers kept in the site's database, pruned by month"""
+        logger = ModificationLogger(self.site, database='modlog')
+        logger.modified(StandInContent(self.site, 'page'), user='bob')
+        self.tm.commit()
+        record = logger.modifications.values()[0]
+        self.assertIs(record.marker._p_jar, self.conn)
+        self.assertEqual(record.get('tid'), self.db.lastTransaction())
+        self.assertNotIn(u'transactions', logger.prune(days=1))
+        self.assertEqual(len(logger.modifications), 1)
+        result = logger.prune(timespec=datetime.now() + timedelta(days=40))
+        self.assertEqual(result[u'modifications'], 1)
+        self.assertEqual(result[u'transactions'], 1)
+        self.tm.commit()
+
+    def test_markers_month_boundary(self):
+        """Test markers kept as long as the newest records referring to them"""
+        logger = ModificationLogger(self.site, database='modlog')
+        now = datetime.now()
+        later = now + timedelta(days=40)  # in a later month
+
+        def log():
+            for uid, when in ((u'uid1', now), (u'uid2', later)):
+                logger.log_change('modify', uid, '/plone/a', 'bob', when=when)
+
+        # in a thread of its own, as its key clock advances to later:
+        thread = threading.Thread(target=log)
+        thread.start()
+        thread.join()
+        self.tm.commit()
+        tid = self.db.lastTransaction()
+        result = logger.prune(timespec=later)
+        self.assertEqual(result[u'modifications'], 1)
+        self.assertNotIn(u'transactions', result)
+        self.tm.commit()
+        markers = logger.backend.markers()
+        self.assertEqual(
+            sum(len(m) for p in markers.values() for m in p.values()), 1)
+        self.assertEqual(logger.modifications.values()[0].get('tid'), tid)
+
+
+class TestAggregates(unittest.TestCase):
+    """Tests for counts of records maintained on insert and prune"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database()
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.logger = ModificationLogger(self.conn.get(self.site_oid))
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_counts(self):
+        """Test counts by user, day and portal type"""
+        days = [datetime(2016, 5, d, 12) for d in (1, 2, 3)]
+        for i in range(12):
+            self.logger.log_change(
+                'delete',
+                u'uid%s' % i,
+                '/plone/page%s' % i,
+                ('alice', 'bob', 'bob')[i % 3],
+                None,
+                days[i // 4],
+                'Folder' if i % 4 == 0 else 'Document',
+                )
+        self.logger.log_change('delete', u'x', '/plone/x', 'eve')
+        deletions = self.logger.deletions
+        self.assertEqual(deletions.counts('portal_type'), {
+            'Folder': 3,
+            'Document': 9,
+            })
+        self.assertEqual(deletions.counts()['bob'], 8)
+        self.assertEqual(deletions.counts('user')['eve'], 1)
+        self.assertEqual(deletions.counts('day')['2016-05-02'], 4)
+        by_day = deletions.counts(('user', 'day'), ('bob',))
+        self.assertEqual(by_day, {
+            ('bob', '2016-05-01'): 2,
+            ('bob', '2016-05-02'): 3,
+            ('bob', '2016-05-03'): 3,
+            })
+        self.assertEqual(
+            deletions.counts(('portal_type', 'day'), ('Folder',)),
+            dict((('Folder', d.date().isoformat()), 1) for d in days),
+            )
+        self.assertRaises(ValueError, deletions.counts, ('uid',))
+        # pruned records are no longer counted:
+        self.logger.prune('delete', timespec=days[1])
+        self.assertEqual(len(deletions), 9)
+        by_day = deletions.counts(('user', 'day'), ('bob',))
+        self.assertNotIn(('bob', '2016-05-01'), by_day)
+        self.assertEqual(deletions.counts('user')['bob'], 6)
+        self.assertEqual(sum(deletions.counts('day').values()), 9)
+
+    def test_shared_segment(self):
+        """Test counts of writers sharing a segment do not conflict"""
+        # conflicts are resolved by FileStorage, not MappingStorage:
+        tmp = tempfile.mkdtemp()
+        db, site_oid = stand_in_database(
+            FileStorage(os.path.join(tmp, 'Data.fs')))
+        try:
+            managers = []
+            for user in ('alice', 'bob', 'eve'):
+                # connections logging in the same (thread's) segment:
+                tm = transaction.TransactionManager()
+                conn = db.open(transaction_manager=tm)
+                logger = ModificationLogger(conn.get(site_oid))
+                logger.log_change('modify', u'uid', '/plone/page', user)
+                if not managers:
+                    tm.commit()  # creates storage, and counts for today
+                managers.append(tm)
+            for tm in managers[1:]:
+                tm.commit()
+            self.assertEqual(logger.modifications.counts('day').values(), [3])
+        finally:
+            db.close()
+            shutil.rmtree(tmp)
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Tests for instrumentation of logging, querying and pruning"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database()
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.site = self.conn.get(self.site_oid)
+        self.sink = instrument.RegistrySink()
+        instrument.add_sink(self.sink)
+
+    def tearDown(self):
+        instrument.remove_sink(self.sink)
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_registry(self):
+        """Test calls, durations and counts totalled per facility"""
+        logger = ModificationLogger(self.site)
+        for i in range(5):
+            content = StandInContent(self.site, 'page%s' % i)
+            logger.modified(content, user='bob' if i % 2 else 'alice')
+        records = list(logger.modifications.limit({'user': 'bob'}))
+        self.assertEqual(len(records), 2)
+        filters = {'path': '/plone/page', 'uid': records[0].get('uid')}
+        list(logger.modifications.limit(filters))
+        logger.prune('modify', days=0)
+        stats = self.sink.snapshot()
+        self.assertEqual(stats[(u'modifications', 'log')]['calls'], 5)
+        insert = stats[(u'modifications', 'insert')]
+        self.assertEqual(insert['calls'], 5)
+        self.assertTrue(insert['bytes'] > 5 * 16)
+        self.assertTrue(insert['max'] <= insert['time'])
+        limit = stats[(u'modifications', 'limit')]
+        self.assertEqual(limit['calls'], 2)
+        self.assertEqual(limit['returned'], 3)
+        self.assertEqual(limit['scanned'], 3)  # only index candidates
+        self.assertEqual(stats[(u'modifications', 'prune')]['removed'], 5)
+        instrument.remove_sink(self.sink)
+        logger.modified(content, user='bob')
+        self.assertEqual(self.sink.snapshot(), stats)
+
+    def test_statsd(self):
+        """Test statsd metrics sent over UDP"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = instrument.StatsdSink(*server.getsockname())
+            sink.emit('limit', 'deletions', 0.25, {'returned': 3})
+            lines = server.recv(4096).splitlines()
+        finally:
+            server.close()
+        self.assertEqual(
+            lines,
+            [
+                'plone.wabac.modlog.deletions.limit:250|ms',
+                'plone.wabac.modlog.deletions.limit.calls:1|c',
+                'plone.wabac.modlog.deletions.limit.returned:3|c',
+                ],
+            )
+
+
+class TestBenchmark(unittest.TestCase):
+    """Smoke test for benchmark harness"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def test_run(self):
+        """Test benchmark of a small log, and comparison table"""
+        results = {200: benchmark.run(200, batch=50, repeat=1)}
+        self.assertTrue(results[200]['objects stored per commit'] > 0)
+        self.assertTrue(results[200]['prune half (records/s)'] > 0)
+        self.assertIn('limit by path, cold (ms)', results[200])
+        baseline = {200: dict((k, v * 2) for k, v in results[200].items())}
+        lines = benchmark.table(results, baseline).splitlines()
+        self.assertEqual(len(lines), len(results[200]) + 1)
+        self.assertIn('200 records', lines[0])
+        self.assertIn('(-50%)', lines[1])
+
+
+class TestLoadSimulator(unittest.TestCase):
+    """Smoke test for concurrent-editor load simulator"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def test_run(self):
+        """Test simulated editors commit, and log, all changes"""
+        results = loadtest.run(3, 10, changes=4, kind='mapping', seed=1)
+        self.assertEqual(results['commits'], 30)
+        self.assertEqual(results['failed'], 0)
+        self.assertTrue(results['records']['additions'] > 0)
+        self.assertTrue(results['p50'] <= results['p95'] <= results['p99'])
+        self.assertIn('commits/s:', loadtest.report(results))
+        self.assertEqual(loadtest.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(loadtest.percentile([1, 2, 3, 4], 99), 4)
+
+
+class TestConcurrentLogging(unittest.TestCase):
+    """Concurrent transactions logging changes must not conflict"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    WRITERS = 8
+
+    TRANSACTIONS = 25
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database()
+        # first logged change creates the facility storage:
+        self.write('setup', 1)
+
+    def tearDown(self):
+        self.db.close()
+
+    def write(self, name, count, gate=None, retries=None, writer=None):
+        if writer is not None:
+            segments.assign_writer(*writer)
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        try:
+            site = conn.get(self.site_oid)
+            logger = ModificationLogger(site)
+            content = StandInContent(site, name)
+            if gate is not None:
+                gate.wait()
+            for i in range(count):
+                while True:
+                    tm.begin()
+                    logger.modified(content, user=name)
+                    try:
+                        tm.commit()
+                        break
+                    except ConflictError:
+                        tm.abort()
+                        retries.append(name)
+        finally:
+            conn.close()
+
+    def run_writers(self, writers):
+        """Run writer threads, given (client, thread) pairs or None"""
+        gate = threading.Event()
+        retries = []
+        threads = [
+            threading.Thread(
+                target=self.write,
+                args=('editor%s' % n, self.TRANSACTIONS, gate, retries),
+                kwargs={'writer': writer},
+                )
+            for n, writer in enumerate(writers)
+            ]
+        for thread in threads:
+            thread.start()
+        gate.set()
+        for thread in threads:
+            thread.join()
+        return retries
+
+    def test_concurrent_inserts(self):
+        """Test many concurrent writers, without conflict retries"""
+        retries = self.run_writers([None] * self.WRITERS)
+        self.assertEqual(retries, [])
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        try:
+            logger = ModificationLogger(conn.get(self.site_oid))
+            facility = logger.modifications
+            expected = self.WRITERS * self.TRANSACTIONS + 1
+            self.assertEqual(len(facility), expected)
+            keys = facility.keys()
+            self.assertEqual(len(set(keys)), expected)
+            self.assertEqual(keys, sorted(keys))
+            self.assertEqual(facility.values()[-1].get('user'), 'setup')
+        finally:
+            conn.close()
+
+    def test_clients(self):
+        """Test writers of distinct clients never share a segment"""
+        slots = [
+            segments.client_slot(client, thread)
+            for client in range(4)
+            for thread in range(segments.THREADS)
+            ]
+        self.assertEqual(sorted(slots), range(segments.SEGMENTS))
+        # two clients of four threads each, numbered from 0:
+        writers = [(c, t) for c in (0, 1) for t in range(4)]
+        self.assertEqual(self.run_writers(writers), [])
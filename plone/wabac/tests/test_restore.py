@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+import json
+import transaction
+import unittest
+
+from plone import api
+from plone.app.testing import TEST_USER_ID, setRoles
+from plone.uuid.interfaces import IUUID
+from ZODB.utils import p64, u64
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+from plone.wabac.modlog import ModificationLogger
+from plone.wabac.modlog.interfaces import IModificationLogger
+from plone.wabac.modlog.records import ChangeRecord, TransactionMarker
+from plone.wabac.modlog.testing import stand_in_database
+from plone.wabac.restore.batch import BatchRestore
+from plone.wabac.restore.content import historical_object
+from plone.wabac.restore.history import HistoricalConnections, before_tid
+from plone.wabac.restore.stream import SubtreeRestore
+from plone.wabac.testing import PLONE_WABAC_FUNCTIONAL_TESTING  # noqa
+from plone.wabac.testing import PLONE_WABAC_INTEGRATION_TESTING  # noqa
+
+
+class TestHistoricalConnections(unittest.TestCase):
+    """Tests for pooled historical connections"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database()
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.site = self.conn.get(self.site_oid)
+        # one transaction per title, tids in order:
+        self.tids = []
+        for n in range(4):
+            self.site.title = 'title%s' % n
+            self.tm.commit()
+            self.tids.append(self.db.lastTransaction())
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_states_before(self):
+        """Test connections read states before tid, and are reused"""
+        pool = HistoricalConnections(self.db)
+        try:
+            site = pool.get_object(self.tids[2], self.site_oid)
+            self.assertEqual(site.title, 'title1')
+            self.assertEqual(self.site.title, 'title3')
+            conn = pool.get(self.tids[2])
+            self.assertIs(conn.get(self.site_oid), site)
+            self.assertEqual((pool.misses, pool.hits), (1, 1))
+            self.assertEqual(
+                pool.get_object(self.tids[1], self.site_oid).title,
+                'title0',
+                )
+            self.assertEqual(len(pool), 2)
+        finally:
+            pool.close()
+        self.assertEqual(len(pool), 0)
+        self.assertIsNone(conn.opened)  # closed
+
+    def test_eviction(self):
+        """Test least recently used connections are evicted"""
+        pool = HistoricalConnections(self.db, connections=2)
+        try:
+            pool.get(self.tids[0])
+            pool.get(self.tids[1])
+            pool.get(self.tids[0])  # most recently used
+            pool.get(self.tids[2])
+            self.assertEqual(list(pool.connections), self.tids[::2][:2])
+            self.assertNotIn(self.tids[1], pool)
+            self.assertEqual(pool.evicted, 1)
+        finally:
+            pool.close()
+        # cache size cap: only most recently used connection is kept,
+        # with cache minimized
+        pool = HistoricalConnections(self.db, cache_mb=0.000001)
+        try:
+            for tid in self.tids[1:]:
+                pool.get_object(tid, self.site_oid).title
+            self.assertEqual(list(pool.connections), [self.tids[3]])
+            pool.get_object(self.tids[3], self.site_oid).title
+            pool.trim()
+            self.assertEqual(pool.estimated_size(), 0)
+        finally:
+            pool.close()
+
+    def test_before_tid(self):
+        """Test tid to read states before a change record from"""
+        when = datetime.now()
+        serial = p64(5)
+        record = ChangeRecord.create(
+            u'uid', '/plone/page', 'bob', when, serial=serial)
+        self.assertEqual(u64(before_tid(record)), 6)
+        record = ChangeRecord.create(u'uid', '/plone/page', 'bob', when)
+        self.assertIsNone(before_tid(record))
+
+
+class TestSeparateLogDatabase(unittest.TestCase):
+    """Tests for restoring from records kept in a separate database"""
+
+    layer = PLONE_WABAC_INTEGRATION_TESTING
+
+    def setUp(self):
+        self.db, self.site_oid = stand_in_database(log_database='modlog')
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        self.site = self.conn.get(self.site_oid)
+        self.site.title = 'before'
+        self.tm.commit()
+        self.serial = self.site._p_serial
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def test_site_tid(self):
+        """Test records keep tids of the site's database, to read from"""
+        logger = ModificationLogger(self.site, database='modlog')
+        self.site.title = 'changed'
+        logger.log_change('modify', u'uid', '/plone', serial=self.serial)
+        self.tm.commit()
+        record = logger.modifications.values()[0]
+        self.assertEqual(record.get('tid'), self.db.lastTransaction())
+        self.site.title = 'later'
+        logger.log_change('modify', u'uid', '/plone')
+        self.tm.commit()
+        pool = HistoricalConnections(self.db)
+        try:
+            site = pool.get_object(before_tid(record, self.db), self.site_oid)
+            self.assertEqual(site.title, 'before')
+        finally:
+            pool.close()
+
+    def test_log_database_tid(self):
+        """Test tids of markers stored in the log database not used"""
+        marker = TransactionMarker()
+        self.conn.get_connection('modlog').add(marker)
+        record = ChangeRecord.create(
+            u'uid', '/plone', 'bob', datetime.now(),
+            marker=marker, serial=self.serial,
+            )
+        self.site.title = 'changed'
+        self.tm.commit()
+        self.assertEqual(before_tid(record), marker.tid)
+        self.assertEqual(
+            u64(before_tid(record, self.db)),
+            u64(self.serial) + 1,
+            )
+
+
+class TestBatchRestore(unittest.TestCase):
+    """Tests for batch restoration of deleted and modified content"""
+
+    layer = PLONE_WABAC_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.archive = api.content.create(
+            type='Folder', id='archive', container=self.portal)
+        self.reports = api.content.create(
+            type='Folder', id='reports', container=self.archive)
+        for id in ('q1', 'q2'):
+            api.content.create(
+                type='Document', id=id, title=id, container=self.reports)
+        self.news = api.content.create(
+            type='Document', id='news', title='News', container=self.portal)
+        transaction.commit()
+        self.logger = IModificationLogger(self.portal)
+
+    def test_restore_folder(self):
+        """Test folder restored with contents, in place, with UUIDs"""
+        uids = [IUUID(self.archive), IUUID(self.reports['q1'])]
+        api.content.delete(self.archive)
+        transaction.commit()
+        self.assertNotIn('archive', self.portal)
+        deleted = list(self.logger.deletions.limit(expand=True))
+        # items removed with a folder are found by UID, for preview:
+        view = self.portal.restrictedTraverse('@@restore-preview')
+        self.assertEqual(
+            [r.get('path') for r in view.records(
+                self.logger.deletions, uids[1:])],
+            ['/plone/archive/reports/q1'],
+            )
+        restore = BatchRestore(self.portal, deleted)
+        result = restore.run()
+        self.assertEqual(result['restored'], ['/plone/archive'])
+        self.assertEqual(
+            [reason for path, reason in result['skipped']],
+            ['with ancestor'] * 3,
+            )
+        q1 = self.portal['archive']['reports']['q1']
+        self.assertEqual([IUUID(self.portal['archive']), IUUID(q1)], uids)
+        self.assertEqual(q1.Title(), 'q1')
+        # restoring again resumes, with nothing left to copy:
+        result = BatchRestore(self.portal, deleted).run()
+        self.assertEqual(result['restored'], ['/plone/archive'])
+        self.assertEqual(
+            self.portal['archive']['reports'].objectIds(), ['q1', 'q2'])
+
+    def test_restore_missing_ancestors(self):
+        """Test missing ancestors recreated once, parent-first, empty"""
+        api.content.delete(self.reports['q1'])
+        transaction.commit()
+        api.content.delete(self.archive)
+        transaction.commit()
+        deletions = self.logger.deletions.limit({'path': '/plone/archive/'})
+        q1 = [r for r in deletions if r.get('path').endswith('/q1')]
+        self.assertEqual(len(q1), 1)
+        self.assertEqual(
+            [(t.kind, t.path) for t in BatchRestore(self.portal, q1).plan()],
+            [
+                ('ancestor', '/plone/archive'),
+                ('ancestor', '/plone/archive/reports'),
+                ('delete', '/plone/archive/reports/q1'),
+                ],
+            )
+        progress = []
+        result = BatchRestore(
+            self.portal, q1, size=1, report=lambda *a: progress.append(a),
+            ).run()
+        self.assertEqual(len(result['restored']), 3)
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        reports = self.portal['archive']['reports']
+        self.assertEqual(reports.objectIds(), ['q1'])
+        self.assertEqual(IUUID(reports), IUUID(self.reports))
+
+    def test_restore_not_acquired(self):
+        """Test ancestors missing recreated, not found by acquisition"""
+        api.content.delete(self.reports['q1'])
+        transaction.commit()
+        api.content.delete(self.reports)
+        api.content.create(type='Folder', id='reports', container=self.portal)
+        transaction.commit()
+        q1 = self.logger.deletions.limit({'path': '/plone/archive/reports/q1'})
+        restore = BatchRestore(self.portal, q1)
+        self.assertEqual(
+            [(t.kind, t.path) for t in restore.plan()],
+            [
+                ('ancestor', '/plone/archive/reports'),
+                ('delete', '/plone/archive/reports/q1'),
+                ],
+            )
+        restore.run()
+        self.assertEqual(
+            self.portal['archive']['reports'].objectIds(), ['q1'])
+        self.assertEqual(self.portal['reports'].objectIds(), [])
+
+    def test_restore_deleted_modified(self):
+        """Test item modified, then deleted, restored from its deletion"""
+        self.news.title = u'Changed'
+        notify(ObjectModifiedEvent(self.news))
+        transaction.commit()
+        uid = IUUID(self.news)
+        api.content.delete(self.news)
+        transaction.commit()
+        restore = BatchRestore(
+            self.portal,
+            deleted=self.logger.deletions.limit({'uid': uid}),
+            modified=self.logger.modifications.limit({'uid': uid}),
+            )
+        self.assertEqual(
+            [(t.kind, t.path) for t in restore.plan()],
+            [('delete', '/plone/news')],
+            )
+        self.assertEqual(restore.run()['restored'], ['/plone/news'])
+        self.assertEqual(self.portal['news'].Title(), 'Changed')
+
+    def test_restore_modified(self):
+        """Test field values of modified content restored in place"""
+        self.news.title = u'Changed'
+        notify(ObjectModifiedEvent(self.news))
+        transaction.commit()
+        modified = self.logger.modifications.limit({'uid': IUUID(self.news)})
+        result = BatchRestore(self.portal, modified=modified).run()
+        self.assertEqual(result['restored'], ['/plone/news'])
+        self.assertEqual(self.portal['news'].Title(), 'News')
+
+    def test_stream_subtree(self):
+        """Test subtree restored item by item, with checkpoints"""
+        uids = [IUUID(self.reports[id]) for id in ('q1', 'q2')]
+        self.portal.portal_workflow.setChainForPortalTypes(
+            ('Folder',), ('simple_publication_workflow',))
+        api.content.transition(obj=self.reports, transition='publish')
+        self.reports.manage_setLocalRoles('bob', ['Reviewer'])
+        self.reports.setLayout('folder_summary_view')
+        transaction.commit()
+        api.content.delete(self.archive)
+        transaction.commit()
+        tid = self.logger.deletions.values()[0].get('tid')
+        connections = HistoricalConnections(self.portal._p_jar.db())
+        try:
+            conn = connections.get(tid)
+            source = historical_object(self.portal, conn, '/plone/archive')
+            progress = []
+            restore = SubtreeRestore(
+                source, self.portal, checkpoint=2, report=progress.append)
+            self.assertEqual(restore.run(), 4)
+            self.assertEqual(progress, [2, 4])
+            # historical objects are deactivated once copied:
+            self.assertIsNone(source._p_changed)
+            reports = self.portal['archive']['reports']
+            self.assertEqual([IUUID(reports[id]) for id in reports], uids)
+            self.assertEqual(reports['q2'].Title(), 'q2')
+            # folders keep their own state (not only field values):
+            self.assertEqual(api.content.get_state(reports), 'published')
+            self.assertEqual(
+                reports.get_local_roles_for_userid('bob'),
+                ('Reviewer',),
+                )
+            self.assertEqual(reports.getLayout(), 'folder_summary_view')
+            brain = self.portal.portal_catalog(UID=IUUID(reports))[0]
+            self.assertEqual(brain.review_state, 'published')
+            # nothing left to copy, when run again:
+            self.assertEqual(SubtreeRestore(source, self.portal).run(), 0)
+        finally:
+            connections.close()
+
+    def test_preview(self):
+        """Test dry run reports conflicts, ancestors and field diffs"""
+        api.content.delete(self.reports['q1'])
+        transaction.commit()
+        api.content.delete(self.archive)
+        self.news.title = u'Changed'
+        notify(ObjectModifiedEvent(self.news))
+        transaction.commit()
+        api.content.create(
+            type='Document', id='archive', container=self.portal)
+        transaction.commit()
+        deleted = list(self.logger.deletions.limit())
+        modified = self.logger.modifications.limit({'uid': IUUID(self.news)})
+        preview = BatchRestore(self.portal, deleted, modified).preview()
+        # the new item at the folder's path is no container for q1:
+        self.assertEqual(
+            preview['conflicts'],
+            ['/plone/archive', '/plone/archive/reports/q1'],
+            )
+        self.assertEqual(preview['ancestors'], [])
+        self.assertEqual(preview['restore'], [('modify', '/plone/news')])
+        self.assertEqual(
+            preview['diffs']['/plone/news']['title'],
+            (u'News', u'Changed'),
+            )
+        self.assertEqual(preview['not_found'], [])
+        # nothing written:
+        self.assertFalse(self.portal._p_jar._registered_objects)
+        self.assertEqual(self.portal['archive'].portal_type, 'Document')
+        # as JSON, by UIDs:
+        request = self.layer['request']
+        request.form.update(modified=IUUID(self.news))
+        view = self.portal.restrictedTraverse('@@restore-preview')
+        data = json.loads(view())
+        self.assertEqual(data['diffs']['/plone/news']['title'][0], u'News')
@@ -10,8 +10,11 @@ def parentPath(path):
     return '/'.join(path.split('/')[:-1])
 
 
-def traversable(path):
-    base = sitePath()
-    
-
-
+def traversable(path, site=None):
+    """Path relative to site (traversable from it), given absolute path"""
+    base = '/'.join(sitePath(site))
+    if path == base:
+        return ''
+    if not path.startswith(base + '/'):
+        raise ValueError('Path not within site: %s' % path)
+    return path[len(base) + 1:]